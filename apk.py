@@ -0,0 +1,137 @@
+"""
+Reads the metadata of APK files without Java or aapt: the binary AndroidManifest.xml
+is parsed straight from the memory-mapped zip file.
+"""
+
+import mmap
+import re
+import struct
+import zipfile
+
+# Chunk types of the binary XML format
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+UTF8_FLAG = 0x100
+# Typed value types
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+# Android attribute resource ids, used when the attribute names are stripped
+attributeIds = {
+    0x0101021b: 'versionCode',
+    0x0101021c: 'versionName'
+}
+
+
+class _MappedFile:
+    '''A file-like view of a memory map that zipfile accepts (mmap is not seekable() before Python 3.13)'''
+
+    def __init__(self, data):
+        self.data = data
+
+    def seekable(self):
+        return True
+
+    def __getattr__(self, name):
+        return getattr(self.data, name)
+
+
+class ApkInfo:
+    '''The identity of an APK file'''
+
+    def __init__(self, package, versionName, versionCode, abis):
+        self.package = package
+        self.versionName = versionName
+        self.versionCode = versionCode
+        self.abis = abis
+
+    def __str__(self):
+        return '{} {} ({})'.format(self.package, self.versionName, self.versionCode)
+
+
+def readApkInfo(path):
+    '''Reads the package, version and native ABIs of an APK. Raises ValueError if it isn't a valid APK'''
+    try:
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with zipfile.ZipFile(_MappedFile(data)) as apk:
+                manifest = apk.read('AndroidManifest.xml')
+                abis = sorted({match[1] for match in map(re.compile(r'^lib/([^/]+)/[^/]+\.so$').match, apk.namelist()) if match})
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        raise ValueError('{} is not a valid APK: {}'.format(path, e))
+    attributes = parseManifestAttributes(manifest)
+    if 'package' not in attributes:
+        raise ValueError('{} has no package name'.format(path))
+    return ApkInfo(attributes['package'], attributes.get('versionName'), attributes.get('versionCode'), abis)
+
+
+def parseManifestAttributes(data):
+    '''Returns the attributes of the root <manifest> element of a binary XML document'''
+    try:
+        chunkType, headerSize, _ = struct.unpack_from('<HHI', data, 0)
+        if chunkType != RES_XML_TYPE:
+            raise ValueError('not a binary XML document')
+        strings, resourceIds = [], []
+        offset = headerSize
+        while offset + 8 <= len(data):
+            chunkType, headerSize, chunkSize = struct.unpack_from('<HHI', data, offset)
+            if chunkSize < 8:
+                break
+            if chunkType == RES_STRING_POOL_TYPE:
+                strings = _parseStringPool(data, offset)
+            elif chunkType == RES_XML_RESOURCE_MAP_TYPE:
+                resourceIds = struct.unpack_from('<{}I'.format((chunkSize - headerSize) // 4), data, offset + headerSize)
+            elif chunkType == RES_XML_START_ELEMENT_TYPE:
+                return _parseStartElement(data, offset + headerSize, strings, resourceIds)
+            offset += chunkSize
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError('corrupt binary XML: {}'.format(e))
+    raise ValueError('no root element')
+
+
+def _parseStringPool(data, offset):
+    stringCount, _, flags, stringsStart, _ = struct.unpack_from('<IIIII', data, offset + 8)
+    headerSize = struct.unpack_from('<H', data, offset + 2)[0]
+    offsets = struct.unpack_from('<{}I'.format(stringCount), data, offset + headerSize)
+    strings = []
+    for stringOffset in offsets:
+        position = offset + stringsStart + stringOffset
+        if flags & UTF8_FLAG:
+            _, position = _utf8Length(data, position)
+            length, position = _utf8Length(data, position)
+            strings.append(data[position:position + length].decode('utf-8', 'replace'))
+        else:
+            length = struct.unpack_from('<H', data, position)[0]
+            position += 2
+            if length & 0x8000:
+                length = ((length & 0x7fff) << 16) | struct.unpack_from('<H', data, position)[0]
+                position += 2
+            strings.append(data[position:position + length * 2].decode('utf-16-le', 'replace'))
+    return strings
+
+
+def _utf8Length(data, position):
+    length = data[position]
+    if length & 0x80:
+        return ((length & 0x7f) << 8) | data[position + 1], position + 2
+    return length, position + 1
+
+
+def _parseStartElement(data, offset, strings, resourceIds):
+    _, nameIndex, attributeStart, attributeSize, attributeCount = struct.unpack_from('<iIHHH', data, offset)
+    if strings[nameIndex] != 'manifest':
+        raise ValueError('the root element is not <manifest>')
+    attributes = {}
+    for i in range(attributeCount):
+        _, nameIndex, rawValue, _, _, dataType, value = struct.unpack_from(
+            '<IIIHBBI', data, offset + attributeStart + i * attributeSize)
+        name = attributeIds.get(resourceIds[nameIndex]) if nameIndex < len(resourceIds) else None
+        name = name or strings[nameIndex]
+        if rawValue != 0xffffffff:
+            attributes[name] = strings[rawValue]
+        elif dataType == TYPE_STRING:
+            attributes[name] = strings[value]
+        elif dataType in (TYPE_INT_DEC, TYPE_INT_HEX):
+            attributes[name] = value
+    return attributes
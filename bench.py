@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+"""
+An offline benchmark of the patcher's orchestration.
+java (revanced-cli) and apkmd are replaced by stub executables with configurable latency,
+GitHub is replaced by a local HTTP server serving fake releases, and synthetic apps with
+APKs of a chosen size are added to the app map. Every combination of app count and patch
+concurrency runs patch.py end-to-end, and the wall time and per-stage metrics are reported.
+Run "python bench.py --help" for the options.
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+repoDir = os.path.dirname(os.path.abspath(__file__))
+
+# Stands in for java: answers the version check, lists the synthetic apps' patches and "patches" APKs by copying them.
+javaStub = r'''#!{python}
+import os, shutil, sys, time
+args = sys.argv[1:]
+if '-version' in args:
+    sys.stderr.write('    java.class.version = 61.0\n')
+elif 'list-patches' in args:
+    time.sleep(float(os.environ['BENCH_LIST_SECONDS']))
+    print('Index: 0\nName: Bench patch\nCompatible packages:')
+    for package in os.environ['BENCH_PACKAGES'].split(','):
+        print('\tPackage name: {{}}\n\tCompatible versions:\n\t\t1.0.0'.format(package))
+elif 'patch' in args:
+    print('INFO: Loading patches', flush=True)
+    time.sleep(float(os.environ['BENCH_PATCH_SECONDS']))
+    shutil.copyfile(args[-1], args[args.index('--out') + 1])
+    print('INFO: "Bench patch" succeeded')
+else:
+    sys.exit(2)
+'''
+
+# Stands in for apkmd: writes a synthetic APK for every app of its config.
+apkmdStub = r'''#!{python}
+import json, os, sys, time
+sys.path.insert(0, {repoDir!r})
+from bench import writeApk
+for app in json.load(open(sys.argv[1]))['apps']:
+    time.sleep(float(os.environ['BENCH_APKMD_SECONDS']))
+    writeApk(app['outFile'] + '.apk', 'com.bench.' + app['repo'], app.get('version', '1.0.0'), int(os.environ['BENCH_APK_BYTES']))
+'''
+
+# Runs patch.py's main() with the benchmark's settings and synthetic apps
+bootstrap = r'''
+import sys
+sys.path.insert(0, {repoDir!r})
+sys.argv = [{scriptPath!r}] + {args!r}
+import device, info
+device.settings['githubApi'] = {apiUrl!r}
+info.appMap.update({apps!r})
+import patch
+patch.main()
+'''
+
+
+def axmlManifest(package, version):
+    '''Builds a minimal binary AndroidManifest.xml'''
+    strings = ['versionCode', 'versionName', 'package', 'manifest', version, package]
+    pool = b''
+    offsets = []
+    for string in strings:
+        offsets.append(len(pool))
+        encoded = string.encode()
+        pool += bytes([len(string), len(encoded)]) + encoded + b'\0'
+    pool += b'\0' * (-len(pool) % 4)
+    start = 28 + 4 * len(strings)
+    stringPool = struct.pack('<HHIIIIII', 0x0001, 28, start + len(pool), len(strings), 0, 0x100, start, 0)
+    stringPool += struct.pack('<{}I'.format(len(strings)), *offsets) + pool
+    resourceMap = struct.pack('<HHIII', 0x0180, 8, 16, 0x0101021b, 0x0101021c)
+    attributes = b''.join(struct.pack('<IIIHBBI', 0xffffffff, name, raw, 8, 0, kind, data) for name, raw, kind, data in (
+        (0, 0xffffffff, 0x10, 1), (1, 4, 0x03, 4), (2, 5, 0x03, 5)))
+    element = struct.pack('<HHIII', 0x0102, 16, 36 + len(attributes), 1, 0xffffffff)
+    element += struct.pack('<iIHHHHHH', -1, 3, 20, 20, 3, 0, 0, 0) + attributes
+    body = stringPool + resourceMap + element
+    return struct.pack('<HHI', 0x0003, 8, 8 + len(body)) + body
+
+
+def writeApk(path, package, version, size):
+    '''Writes a synthetic APK of roughly the given size'''
+    with zipfile.ZipFile(path, 'w') as apk:
+        apk.writestr('AndroidManifest.xml', axmlManifest(package, version))
+        apk.writestr('lib/arm64-v8a/libbench.so', b'\0' * 1024)
+        block = os.urandom(1 << 20)
+        with apk.open('classes.dex', 'w') as dex:
+            for written in range(0, size, len(block)):
+                dex.write(block[:size - written])
+
+
+class FakeGitHub(http.server.ThreadingHTTPServer):
+    '''Serves fake release metadata and assets for the tools, logging the (path, status) of each request'''
+
+    def __init__(self, assets, releases):
+        self.assets = assets
+        self.releases = releases
+        self.requests = []
+        super().__init__(('127.0.0.1', 0), FakeGitHubHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/assets/'):
+            body, etag = self.server.assets[self.path[8:]], None
+        elif self.path in self.server.releases:
+            body = json.dumps(self.server.releases[self.path]).encode()
+            etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+        else:
+            body, etag = b'', None
+        status = 200 if body else 404
+        if etag and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.server.requests.append((self.path, status))
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def fakeReleases(server, apkmdScript):
+    '''Registers the rv tools and apkmd with the fake GitHub server'''
+    tools = [
+        ('revanced/revanced-cli', 'v5.0.0', 'revanced-cli-5.0.0-all.jar', 'application/java-archive', os.urandom(1 << 20)),
+        ('revanced/revanced-patches', 'v5.0.0', 'patches-5.0.0.rvp', 'text/plain', os.urandom(1 << 20)),
+        ('tanishqmanuja/apkmirror-downloader', 'v2.0.0', 'apkmd', 'application/octet-stream', apkmdScript.encode())
+    ]
+    for project, tag, name, contentType, data in tools:
+        server.assets[name] = data
+        server.releases['/repos/{}/releases/latest'.format(project)] = {
+            'tag_name': tag,
+            'assets': [{
+                'name': name,
+                'content_type': contentType,
+                'size': len(data),
+                'digest': 'sha256:' + hashlib.sha256(data).hexdigest(),
+                'browser_download_url': '{}/assets/{}'.format(server.url, name)
+            }]
+        }
+
+
+def runOnce(workDir, apps, jobs, env, apiUrl):
+    '''Runs one patch.py batch, returning its wall time and per-stage wall times'''
+    for name in ('APKs', 'metrics'):
+        shutil.rmtree(os.path.join(workDir, 'tools', name), ignore_errors=True)
+    shutil.rmtree(os.path.join(workDir, 'Patched-APKs'), ignore_errors=True)
+    code = bootstrap.format(
+        repoDir=repoDir, scriptPath=os.path.join(workDir, 'patch.py'), apiUrl=apiUrl,
+        apps=apps, args=sorted(apps) + ['--jobs', str(jobs), '--force'])
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], cwd=workDir, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode:
+        raise RuntimeError('patch.py failed:\n' + result.stdout[-2000:])
+    stages = {}
+    with open(os.path.join(workDir, 'tools', 'metrics', 'metrics.jsonl')) as file:
+        for line in file:
+            record = json.loads(line)
+            stages[record['stage']] = stages.get(record['stage'], 0) + record['wall']
+    return wall, stages
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='ReVanced Auto Patcher benchmark',
+        description='Measures the end-to-end throughput of patch.py against stub tools, fully offline.')
+    parser.add_argument('--apps', default='1,10,100',
+                        help='Comma-separated numbers of apps per run (default: %(default)s)')
+    parser.add_argument('--jobs', default='1,2,4,8',
+                        help='Comma-separated patch concurrency levels (default: %(default)s)')
+    parser.add_argument('--apk-mb', type=float, default=4,
+                        help='Size of the synthetic APKs in MB (default: %(default)s)')
+    parser.add_argument('--patch-seconds', type=float, default=0.5,
+                        help='Latency of a stub patch run (default: %(default)s)')
+    parser.add_argument('--list-seconds', type=float, default=1,
+                        help='Latency of a stub list-patches run (default: %(default)s)')
+    parser.add_argument('--apkmd-seconds', type=float, default=0.1,
+                        help='Latency of the stub downloader per app (default: %(default)s)')
+    parser.add_argument('--output',
+                        help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='revanced-bench-')
+    try:
+        binDir = os.path.join(workDir, 'bin')
+        os.makedirs(binDir)
+        with open(os.path.join(binDir, 'java'), 'w') as file:
+            file.write(javaStub.format(python=sys.executable))
+        os.chmod(os.path.join(binDir, 'java'), 0o755)
+        server = FakeGitHub({}, {})
+        fakeReleases(server, apkmdStub.format(python=sys.executable, repoDir=repoDir))
+
+        results = []
+        for appCount in (int(i) for i in args.apps.split(',')):
+            apps = {
+                'Bench App {:03}'.format(i): {
+                    'package': 'com.bench.app{:03}'.format(i),
+                    'org': 'bench',
+                    'repo': 'app{:03}'.format(i)
+                } for i in range(appCount)
+            }
+            env = dict(os.environ,
+                       PATH=binDir + os.pathsep + os.environ['PATH'],
+                       BENCH_PACKAGES=','.join(i['package'] for i in apps.values()),
+                       BENCH_PATCH_SECONDS=str(args.patch_seconds),
+                       BENCH_LIST_SECONDS=str(args.list_seconds),
+                       BENCH_APKMD_SECONDS=str(args.apkmd_seconds),
+                       BENCH_APK_BYTES=str(int(args.apk_mb * (1 << 20))))
+            # The patch index of the previous app set is outdated
+            shutil.rmtree(os.path.join(workDir, 'tools', 'RV', 'cache'), ignore_errors=True)
+            for jobs in (int(i) for i in args.jobs.split(',')):
+                wall, stages = runOnce(workDir, apps, jobs, env, server.url)
+                results.append({'apps': appCount, 'jobs': jobs, 'wall': wall, 'stages': stages})
+                print('{:>5} apps {:>3} jobs: {:8.2f} s, {:6.2f} apps/s | {}'.format(
+                    appCount, jobs, wall, appCount / wall,
+                    ', '.join('{} {:.2f}s'.format(i, j) for i, j in sorted(stages.items(), key=lambda i: -i[1]))))
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=1)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Persistent caches of intermediate patching data.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from util import fileHash, readJson, writeJson, replaceFile, removeTree
+
+
+class ResourceCache:
+    '''A size-capped directory of reusable patch intermediates, such as decoded resources.
+    Each entry is keyed by the input APK and tool versions, is used by one job at a time,
+    and the least recently used entries are evicted once the byte budget is exceeded.'''
+
+    def __init__(self, directory, budgetBytes):
+        self.directory = directory
+        self.budgetBytes = budgetBytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def Entry(self, key):
+        '''Reserves the entry directory of a key, or yields None if another job is using it'''
+        path = os.path.join(self.directory, key)
+        lockPath = path + '.lock'
+        with self.lock:
+            acquired = self.__acquire(lockPath)
+        if not acquired:
+            yield None
+            return
+        try:
+            os.makedirs(path, exist_ok=True)
+            os.utime(path)
+            yield path
+        finally:
+            os.remove(lockPath)
+            self.Evict()
+
+    def Evict(self):
+        '''Deletes the least recently used unlocked entries until the cache fits its budget'''
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if '.trash-' in name:
+                    removeTree(path)
+                elif os.path.isdir(path) and not os.path.exists(path + '.lock'):
+                    entries.append((os.path.getmtime(path), ResourceCache.__treeSize(path), path))
+            total = sum(i[1] for i in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.budgetBytes:
+                    break
+                removeTree(path)
+                total -= size
+
+    @staticmethod
+    def __acquire(lockPath):
+        '''Creates a lock file holding our pid, taking over locks of processes that died'''
+        for _ in range(2):
+            try:
+                fd = os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                with os.fdopen(fd, 'w') as file:
+                    file.write(str(os.getpid()))
+                return True
+            except FileExistsError:
+                try:
+                    with open(lockPath) as file:
+                        pid = int(file.read() or 0)
+                    if pid == os.getpid() or ResourceCache.__alive(pid, lockPath):
+                        return False
+                    os.remove(lockPath)
+                except (OSError, ValueError):
+                    return False
+        return False
+
+    @staticmethod
+    def __alive(pid, lockPath):
+        if os.name == 'nt':
+            # os.kill would terminate the process on Windows, so only expire old locks there
+            return time.time() - os.path.getmtime(lockPath) < 24 * 3600
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    @staticmethod
+    def __treeSize(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(path) for name in names)
+
+
+class HashCache:
+    '''Remembers file hashes by path, size and modification time, so unchanged files aren't hashed again'''
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = readJson(path, {})
+        self.lock = threading.Lock()
+
+    def Hash(self, filePath):
+        stat = os.stat(filePath)
+        filePath = os.path.abspath(filePath)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            entry = self.hashes.get(filePath)
+            if entry and entry[:2] == signature:
+                return entry[2]
+        digest = fileHash(filePath)
+        with self.lock:
+            self.hashes = {i: j for i, j in self.hashes.items() if os.path.exists(i)}
+            self.hashes[filePath] = signature + [digest]
+            writeJson(self.path, self.hashes)
+        return digest
+
+
+class BuildCache:
+    '''Maps the inputs of a patch to the APK it produced, so unchanged builds are not patched again.
+    A build is keyed by the source APK hash, the tool hashes and the effective patch options.
+    Its artifact is kept as a hard link (or copy) next to the index in the cache directory.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.indexPath = os.path.join(directory, 'index.json')
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.index = readJson(self.indexPath, {'builds': {}, 'hits': 0, 'misses': 0})
+
+    @staticmethod
+    def Key(apkHash, toolHashes, options):
+        '''Computes the key of a build from its inputs'''
+        inputs = {'apk': apkHash, 'tools': sorted(toolHashes), 'options': options}
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def Restore(self, key, outPath):
+        '''Places the cached artifact of a build at the output path. Returns False on a cache miss'''
+        with self.lock:
+            build = self.index['builds'].get(key)
+            artifactPath = os.path.join(self.directory, key + '.apk')
+            if not build or not os.path.exists(artifactPath) or os.path.getsize(artifactPath) != build['size']:
+                self.index['misses'] += 1
+                self.__save()
+                return False
+            if not BuildCache.__sameFile(artifactPath, outPath):
+                BuildCache.__link(artifactPath, outPath)
+            build['used'] = time.time()
+            self.index['hits'] += 1
+            self.__save()
+        return True
+
+    def Store(self, key, outPath, app = None):
+        '''Records the artifact of a finished build of an app'''
+        with self.lock:
+            BuildCache.__link(outPath, os.path.join(self.directory, key + '.apk'))
+            self.index['builds'][key] = {
+                'name': os.path.basename(outPath),
+                'app': app,
+                'size': os.path.getsize(outPath),
+                'created': time.time(),
+                'used': time.time()
+            }
+            self.__save()
+
+    def Contains(self, key):
+        '''Whether a build is cached, without counting a hit or miss'''
+        with self.lock:
+            build = self.index['builds'].get(key)
+            artifactPath = os.path.join(self.directory, key + '.apk')
+            return bool(build) and os.path.exists(artifactPath) and os.path.getsize(artifactPath) == build['size']
+
+    def ArtifactPath(self, key):
+        return os.path.join(self.directory, key + '.apk')
+
+    def Previous(self, app, key):
+        '''Returns the artifact path of the newest build of an app before the given build, or None'''
+        with self.lock:
+            builds = [(build.get('created', 0), otherKey) for otherKey, build in self.index['builds'].items()
+                      if build.get('app') == app and otherKey != key
+                      and os.path.exists(os.path.join(self.directory, otherKey + '.apk'))]
+        return os.path.join(self.directory, max(builds)[1] + '.apk') if builds else None
+
+    def Stats(self):
+        '''Returns the number of builds, their total size, and the hit and miss counts'''
+        with self.lock:
+            builds = self.index['builds'].values()
+            return len(builds), sum(i['size'] for i in builds), self.index['hits'], self.index['misses']
+
+    def __save(self):
+        writeJson(self.indexPath, self.index)
+
+    @staticmethod
+    def __sameFile(path, otherPath):
+        try:
+            return os.path.samefile(path, otherPath)
+        except OSError:
+            return False
+
+    @staticmethod
+    def __link(srcPath, dstPath):
+        '''Hard links a file into place atomically, copying it where links aren't possible'''
+        tempPath = '{}.{}.tmp'.format(dstPath, threading.get_ident())
+        try:
+            os.link(srcPath, tempPath)
+            os.replace(tempPath, dstPath)
+        except OSError:
+            shutil.copyfile(srcPath, tempPath)
+            replaceFile(tempPath, dstPath)
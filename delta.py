@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+"""
+Binary deltas between successive builds of an APK, so devices only download what changed.
+The new APK is described as ranges copied from the old one plus LZMA-compressed new data,
+matched per zip entry: entries whose compressed bytes are unchanged cost a few bytes each.
+Applying a delta rebuilds the exact new file (keeping its signature valid) and checks its hash.
+Run "python delta.py --help" to make or apply deltas by hand.
+"""
+
+import argparse
+import hashlib
+import json
+import lzma
+import mmap
+import os
+import struct
+import tempfile
+import zipfile
+
+magic = b'RVDELTA1'
+
+
+def _entryRanges(path, data):
+    '''Returns the (start, end, key) of the compressed data of every zip entry, by position'''
+    ranges = []
+    try:
+        with zipfile.ZipFile(path) as apk:
+            for info in apk.infolist():
+                if not info.compress_size:
+                    continue
+                nameLength, extraLength = struct.unpack_from('<HH', data, info.header_offset + 26)
+                start = info.header_offset + 30 + nameLength + extraLength
+                ranges.append((start, start + info.compress_size,
+                               (info.CRC, info.compress_size, info.file_size, info.compress_type)))
+    except (zipfile.BadZipFile, struct.error) as e:
+        raise ValueError('{} is not a valid APK: {}'.format(path, e))
+    return sorted(ranges)
+
+
+def _fileHash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def makeDelta(oldPath, newPath, deltaPath):
+    '''Writes the delta from oldPath to newPath. Returns the numbers of copied and new bytes'''
+    with open(oldPath, 'rb') as oldFile, mmap.mmap(oldFile.fileno(), 0, access=mmap.ACCESS_READ) as old, \
+         open(newPath, 'rb') as newFile, mmap.mmap(newFile.fileno(), 0, access=mmap.ACCESS_READ) as new:
+        candidates = {}
+        for start, end, key in _entryRanges(oldPath, old):
+            candidates.setdefault(key, []).append(start)
+
+        ops = []
+        copied = 0
+        compressor = lzma.LZMACompressor(preset=6)
+        with tempfile.TemporaryFile() as literals:
+
+            def addData(start, end):
+                if end > start:
+                    literals.write(compressor.compress(new[start:end]))
+                    ops.append(['data', end - start])
+
+            position = 0
+            for start, end, key in _entryRanges(newPath, new):
+                match = next((i for i in candidates.get(key, ()) if old[i:i + end - start] == new[start:end]), None)
+                if match is None:
+                    continue
+                addData(position, start)
+                if ops and ops[-1][0] == 'copy' and ops[-1][1] + ops[-1][2] == match:
+                    ops[-1][2] += end - start
+                else:
+                    ops.append(['copy', match, end - start])
+                copied += end - start
+                position = end
+            addData(position, len(new))
+            literals.write(compressor.flush())
+
+            header = json.dumps({
+                'base': _fileHash(old),
+                'target': _fileHash(new),
+                'size': len(new),
+                'ops': ops
+            }).encode()
+            directory = os.path.dirname(os.path.abspath(deltaPath))
+            fd, tempPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(magic + struct.pack('<I', len(header)) + header)
+                    literals.seek(0)
+                    for chunk in iter(lambda: literals.read(1 << 20), b''):
+                        file.write(chunk)
+                os.chmod(tempPath, 0o644)
+                os.replace(tempPath, deltaPath)
+            except BaseException:
+                os.remove(tempPath)
+                raise
+        return copied, len(new) - copied
+
+
+def applyDelta(oldPath, deltaPath, outPath):
+    '''Rebuilds the new APK from the old one and a delta. Raises ValueError if the old APK
+    is not the delta's base, or the result does not match the hash the delta was made for.'''
+    with open(deltaPath, 'rb') as deltaFile:
+        if deltaFile.read(len(magic)) != magic:
+            raise ValueError('{} is not a delta file'.format(deltaPath))
+        header = json.loads(deltaFile.read(struct.unpack('<I', deltaFile.read(4))[0]))
+        with open(oldPath, 'rb') as oldFile, mmap.mmap(oldFile.fileno(), 0, access=mmap.ACCESS_READ) as old:
+            if _fileHash(old) != header['base']:
+                raise ValueError('{} is not the build the delta was made from'.format(oldPath))
+            directory = os.path.dirname(os.path.abspath(outPath))
+            fd, tempPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                digest = hashlib.sha256()
+                with os.fdopen(fd, 'wb') as file, lzma.LZMAFile(deltaFile) as literals:
+                    for kind, *args in header['ops']:
+                        if kind == 'copy':
+                            offset, length = args
+                            chunks = (old[i:min(i + (1 << 20), offset + length)] for i in range(offset, offset + length, 1 << 20))
+                        else:
+                            length = args[0]
+                            chunks = (literals.read(min(1 << 20, length - i)) for i in range(0, length, 1 << 20))
+                        for chunk in chunks:
+                            digest.update(chunk)
+                            file.write(chunk)
+                    size = file.tell()
+                if size != header['size'] or digest.hexdigest() != header['target']:
+                    raise ValueError('the rebuilt APK does not match the delta\'s target hash')
+                os.chmod(tempPath, 0o644)
+                os.replace(tempPath, outPath)
+            except BaseException:
+                os.remove(tempPath)
+                raise
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='ReVanced Auto Patcher deltas',
+        description='Makes or applies a binary delta between two builds of an APK.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    make = commands.add_parser('make', help='Make the delta from the old to the new APK')
+    make.add_argument('old')
+    make.add_argument('new')
+    make.add_argument('delta')
+    apply = commands.add_parser('apply', help='Rebuild the new APK from the old one and a delta, checking its hash')
+    apply.add_argument('old')
+    apply.add_argument('delta')
+    apply.add_argument('out')
+    args = parser.parse_args()
+
+    if args.command == 'make':
+        copied, added = makeDelta(args.old, args.new, args.delta)
+        print('### Wrote {} ({:.1f} MB reused, {:.1f} MB new, {:.1f} MB delta).'.format(
+            args.delta, copied / (1 << 20), added / (1 << 20), os.path.getsize(args.delta) / (1 << 20)))
+    else:
+        try:
+            applyDelta(args.old, args.delta, args.out)
+        except (ValueError, lzma.LZMAError) as e:
+            print('### Error: {}'.format(e))
+            exit(1)
+        print('### Rebuilt {}, its hash is correct.'.format(args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,5 +13,44 @@ settings = {
         'arch': 'arm64-v8a',                                # The architecture of downloaded APKs: armeabi-v7a or arm64-v8a or x86 or x86_64.
         'dpi': 'nodpi'                                      # The DPI of the downloaded APIs: 240dpi, 320dpi, ...
     },
-    'defaultPatchSource': 'rv'                              # Select whether the default provider should be ReVanced or ReVancedExtended
+    'defaultPatchSource': 'rv',                             # Select whether the default provider should be ReVanced or ReVancedExtended
+    'githubApi': 'https://api.github.com',                  # The GitHub API from which tool releases are looked up
+    'releaseCacheTtl': 3600,                                # Seconds for which cached tool release data is trusted before revalidating it
+    'downloadWorkers': 4,                                   # The number of tool files downloaded at the same time
+    'patchJobs': 1,                                         # The number of APKs patched at the same time
+    'downloadJobs': 2,                                      # The number of APK download batches run at the same time
+    'downloadBatchSize': 4,                                 # The number of apps downloaded by one downloader run
+    'downloadRetries': 3,                                   # The number of times a failed download is retried
+    'retryDelay': 2,                                        # Seconds before the first retry, doubling with each further retry
+    'maxRetryDelay': 60,                                    # The longest wait before a retry in seconds
+    'watchInterval': 3600,                                  # Seconds between the checks for new releases in watch mode (--watch)
+    'watchJitter': 0.1,                                     # Random variation of the watch interval, as a fraction of it
+    'workerToken': None,                                    # The shared secret of a coordinator and its workers (like --token)
+    'heartbeatInterval': 10,                                # Seconds between the heartbeats a worker sends while patching
+    'heartbeatTimeout': 45,                                 # Seconds without heartbeats after which a worker's job is reassigned
+    'jvmDaemon': False,                                     # Whether to run the patcher on warm JVM workers (like --daemon)
+    'jvmRecycleAfter': 20,                                  # The number of jobs after which a warm JVM worker is restarted
+    'metricsDir': os.path.join(scriptDir, 'tools', 'metrics'),  # Stage timings are exported here as JSON lines and a Prometheus textfile
+    'buildDeltas': True,                                    # Whether to write a binary delta from each app's previous build to Patched-APKs/deltas
+    'resourceCacheMB': 4096,                                # Disk space kept for reusable patching data, such as decoded resources
+    'watchdog': {                                           # Limits after which a hung patcher or downloader process is stopped (None for no limit):
+        'idleSeconds': 600,                                 # Seconds a process may run without printing anything
+        'patchSeconds': 3600,                               # Seconds a patch or a listing of the patches may take
+        'downloadSeconds': 3600                             # Seconds a run of the APK downloader may take
+    },
+    'store': {                                              # Retention of the downloaded APKs, patched APKs and tools kept in tools/store:
+        'keepVersions': 3,                                  # Versions kept of each app, build and tool (the newest one is always kept)
+        'budgetMB': 20480                                   # Disk space the stored files may use together (None for no limit)
+    },
+    'governor': {                                           # Limits for running several patch JVMs at the same time:
+        'memoryFraction': 0.8,                              # Share of the physical memory the patch JVMs may use together
+        'cores': None,                                      # CPU cores the patch JVMs may use together (all if None)
+        'coresPerJob': 2,                                   # CPU cores given to each patch JVM
+        'minHeapMB': 768,                                   # Smallest JVM heap given to a patch
+        'maxHeapMB': 8192,                                  # Largest JVM heap given to a patch
+        'heapPerApkMB': 8,                                  # Heap MB per MB of input APK, when the app was never patched before
+        'headroom': 1.25,                                   # Heap given on top of the app's previously measured peak memory
+        'jvmOverhead': 1.3,                                 # Memory used by a JVM relative to its heap
+        'failureGrowth': 1.5                                # Growth of the remembered peak memory after a failed patch
+    }
 }
\ No newline at end of file
@@ -0,0 +1,405 @@
+"""
+Distributes patch jobs across machines: a coordinator hands the jobs of its run to remote
+workers over HTTP. Workers fetch the tools and input APKs by their SHA-256 hash, patch,
+and upload the result, sending heartbeats meanwhile so the jobs of dead workers are reassigned.
+
+Protocol (JSON unless noted, every request carrying the shared token):
+    POST /jobs/claim            {"worker"} -> 200 job spec, or 204 if there is no job
+    POST /jobs/<id>/heartbeat   {"worker"} -> 200, or 409 if the job was taken away
+    POST /jobs/<id>/release     {"worker", "error"}, when the worker could not run the job
+    PUT  /jobs/<id>/keystore    keystore bytes, when the job was sent without one
+    PUT  /jobs/<id>/result      the patched APK (or the output log on failure), with the
+                                X-Worker, X-Exit-Code and X-Sha256 headers
+    GET  /blobs/<sha256>[.ext]  a tool, input APK or keystore
+"""
+
+import hashlib
+import hmac
+import http.server
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from download import Downloader, DownloadItem
+from resources import runProcess
+from util import removeTree
+
+
+class RemoteJob:
+    '''A patch job handed out by the coordinator'''
+
+    def __init__(self, id, args, blobs, heap, outPath, keystorePath):
+        self.id = id
+        self.args = args
+        self.blobs = blobs
+        self.heap = heap
+        self.outPath = outPath
+        self.keystorePath = keystorePath
+        self.worker = None
+        self.heartbeat = 0
+        self.attempts = 0
+        self.returncode = None
+        self.log = ''
+        self.done = threading.Event()
+
+    def Spec(self):
+        return {'id': self.id, 'args': self.args, 'blobs': self.blobs, 'heap': self.heap}
+
+
+class Coordinator(http.server.ThreadingHTTPServer):
+    '''Serves patch jobs to remote workers. Run() is called from the patch stage in place of the
+    local JVM and blocks until a worker returned the job's result. The token is required, as the
+    jobs' files include the keystore. Raises OSError if the address can't be listened on.'''
+
+    daemon_threads = True
+
+    def __init__(self, address, token, heartbeatTimeout = 45, maxAttempts = 3):
+        if not token:
+            raise ValueError('A coordinator needs a token')
+        super().__init__(address, CoordinatorHandler)
+        self.token = token
+        self.heartbeatTimeout = heartbeatTimeout
+        self.maxAttempts = maxAttempts
+        self.blobs = {}
+        self.pending = []
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        threading.Thread(target=self.__reaper, daemon=True).start()
+
+    def Run(self, args, blobs, heap, outPath, keystorePath):
+        '''Runs a cli command on a worker. The blobs map names to the (path, SHA-256) of the files the
+        job needs: the "cli" jar, and any others the args refer to as "{name}". The args may also refer
+        to the output APK, keystore and temporary directory as "{out}", "{keystore}" and "{tmp}".
+        Without a "keystore" blob, the worker creates the keystore and it is stored at keystorePath.
+        Returns the exit code once the output APK is at outPath.'''
+        # Blobs are named by their hash, keeping the extension the tools may rely on
+        names = {name: digest + os.path.splitext(path)[1] for name, (path, digest) in blobs.items()}
+        with self.lock:
+            for path, digest in blobs.values():
+                self.blobs[digest] = path
+            job = RemoteJob(str(next(self.ids)), args, names, heap, outPath, keystorePath)
+            self.jobs[job.id] = job
+            self.pending.append(job)
+        job.done.wait()
+        with self.lock:
+            del self.jobs[job.id]
+        if job.returncode:
+            print('### The worker {} failed the job:\n{}'.format(job.worker, job.log))
+        return job.returncode
+
+    def Close(self):
+        self.shutdown()
+        self.server_close()
+
+    def Claim(self, worker):
+        with self.lock:
+            if not self.pending:
+                return None
+            job = self.pending.pop(0)
+            job.worker = worker
+            job.heartbeat = time.monotonic()
+            job.attempts += 1
+        print('### Job {} was handed to {}.'.format(job.id, worker))
+        return job
+
+    def Heartbeat(self, jobId, worker):
+        '''Returns whether the worker still owns the job'''
+        with self.lock:
+            job = self.jobs.get(jobId)
+            if not job or job.worker != worker or job.done.is_set():
+                return False
+            job.heartbeat = time.monotonic()
+            return True
+
+    def Release(self, jobId, worker, error):
+        '''Takes back a job the worker could not run, to hand it to another one'''
+        with self.lock:
+            job = self.jobs.get(jobId)
+            if not job or job.worker != worker or job.done.is_set():
+                return False
+            print('### The worker {} could not run job {}: {}'.format(worker, jobId, error))
+            self.__requeue(job)
+        return True
+
+    def __requeue(self, job):
+        job.worker = None
+        if job.attempts < self.maxAttempts:
+            self.pending.append(job)
+        else:
+            self.Finish(job, 1, 'Gave up after {} attempts.'.format(job.attempts))
+
+    def Finish(self, job, returncode, log = ''):
+        job.returncode = returncode
+        job.log = log
+        job.done.set()
+
+    def __reaper(self):
+        '''Requeues the jobs of workers that stopped sending heartbeats'''
+        while True:
+            time.sleep(self.heartbeatTimeout / 4)
+            now = time.monotonic()
+            with self.lock:
+                lost = [i for i in self.jobs.values()
+                        if i.worker and not i.done.is_set() and now - i.heartbeat > self.heartbeatTimeout]
+                for job in lost:
+                    print('### The worker {} stopped responding during job {}.'.format(job.worker, job.id))
+                    self.__requeue(job)
+
+
+class CoordinatorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if not self.__authorized():
+            return
+        parts = self.path.strip('/').split('/')
+        with self.server.lock:
+            path = self.server.blobs.get(parts[1].split('.')[0]) if len(parts) == 2 and parts[0] == 'blobs' else None
+        if not path or not os.path.exists(path):
+            return self.__reply(404)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as file:
+            shutil.copyfileobj(file, self.wfile, 1 << 20)
+
+    def do_POST(self):
+        if not self.__authorized():
+            return
+        parts = self.path.strip('/').split('/')
+        data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        worker = data.get('worker', '?')
+        if parts == ['jobs', 'claim']:
+            job = self.server.Claim(worker)
+            return self.__reply(200, job.Spec()) if job else self.__reply(204)
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'heartbeat':
+            return self.__reply(200 if self.server.Heartbeat(parts[1], worker) else 409)
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'release':
+            return self.__reply(200 if self.server.Release(parts[1], worker, data.get('error')) else 409)
+        self.__reply(404)
+
+    def do_PUT(self):
+        if not self.__authorized():
+            return
+        parts = self.path.strip('/').split('/')
+        length = int(self.headers.get('Content-Length', 0))
+        worker = self.headers.get('X-Worker', '?')
+        job = self.server.jobs.get(parts[1]) if len(parts) == 3 and parts[0] == 'jobs' else None
+        if not job or parts[2] not in ('keystore', 'result'):
+            self.rfile.read(length)
+            return self.__reply(404)
+        if not self.server.Heartbeat(job.id, worker):
+            self.rfile.read(length)
+            return self.__reply(409)
+        returncode = int(self.headers.get('X-Exit-Code', 0))
+        if parts[2] == 'result' and returncode:
+            self.server.Finish(job, returncode, self.rfile.read(length).decode('utf-8', 'replace'))
+            return self.__reply(200)
+
+        path = job.keystorePath if parts[2] == 'keystore' else job.outPath
+        fd, partPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.part')
+        digest = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as file:
+            while length > 0:
+                chunk = self.rfile.read(min(length, 1 << 20))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                digest.update(chunk)
+                file.write(chunk)
+        if length or digest.hexdigest() != self.headers.get('X-Sha256'):
+            os.remove(partPath)
+            return self.__reply(400)
+        os.chmod(partPath, 0o644)
+        if parts[2] == 'keystore':
+            if os.path.exists(path):
+                # Another worker created it first
+                os.remove(partPath)
+            else:
+                os.replace(partPath, path)
+        else:
+            os.replace(partPath, path)
+            self.server.Finish(job, 0)
+        self.__reply(200)
+
+    def __authorized(self):
+        expected = 'Bearer ' + self.server.token
+        if not hmac.compare_digest(self.headers.get('Authorization', '').encode(), expected.encode()):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.__reply(401)
+            return False
+        return True
+
+    def __reply(self, status, data = None):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RemoteWorker:
+    '''Claims jobs from a coordinator and runs them with the local java. Tools are kept in a blob
+    cache by their hash, so they are only transferred once per version.'''
+
+    def __init__(self, url, blobDir, workDir, governor, name = None, token = None,
+                 slots = 1, pollInterval = 5, heartbeatInterval = 10, idleTimeout = None, totalTimeout = None):
+        self.url = url.rstrip('/')
+        self.blobDir = blobDir
+        self.workDir = workDir
+        self.governor = governor
+        self.name = name or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.token = token
+        self.slots = slots
+        self.pollInterval = pollInterval
+        self.heartbeatInterval = heartbeatInterval
+        # A job whose JVM hangs is released, so the coordinator can hand it out again
+        self.idleTimeout = idleTimeout
+        self.totalTimeout = totalTimeout
+        os.makedirs(blobDir, exist_ok=True)
+        os.makedirs(workDir, exist_ok=True)
+        headers = {'Authorization': 'Bearer ' + token} if token else {}
+        self.downloader = Downloader(workers=4, headers=headers)
+        self.stopped = threading.Event()
+
+    def Run(self):
+        '''Works on jobs until interrupted or stopped'''
+        print('### Worker {} is waiting for jobs from {}.'.format(self.name, self.url))
+        threads = [threading.Thread(target=self.__loop, daemon=True) for _ in range(self.slots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+
+    def Stop(self):
+        '''Stops claiming jobs. Run returns once the running jobs finished'''
+        self.stopped.set()
+
+    def __loop(self):
+        while not self.stopped.is_set():
+            try:
+                spec = self.__request('POST', '/jobs/claim', {'worker': self.name})
+            except (OSError, ValueError) as e:
+                print('### The coordinator is unreachable: {}'.format(e))
+                spec = None
+            if not spec:
+                self.stopped.wait(self.pollInterval * random.uniform(0.5, 1.5))
+                continue
+            try:
+                self.__process(spec)
+            except (OSError, RuntimeError) as e:
+                print('### Job {} failed: {}'.format(spec['id'], e))
+                try:
+                    self.__request('POST', '/jobs/{}/release'.format(spec['id']), {'worker': self.name, 'error': str(e)})
+                except OSError:
+                    # The coordinator reassigns the job once the heartbeats stop
+                    pass
+
+    def __process(self, spec):
+        print('### Running job {}...'.format(spec['id']))
+        workspace = tempfile.mkdtemp(prefix='job-', dir=self.workDir)
+        owned = threading.Event()
+        owned.set()
+        stopped = threading.Event()
+        threading.Thread(target=self.__heartbeat, args=(spec['id'], owned, stopped), daemon=True).start()
+        try:
+            paths = self.__fetchBlobs(spec['blobs'], workspace)
+            values = dict(paths, out=os.path.join(workspace, 'out.apk'), tmp=os.path.join(workspace, 'tmp'))
+            values.setdefault('keystore', os.path.join(workspace, 'patch.keystore'))
+            args = [i.format(**values) for i in spec['args']]
+            lines = []
+            with self.governor.Admit(spec['heap']):
+                returncode, _ = runProcess(
+                    ['java', *self.governor.JvmArgs(spec['heap']), '-jar', paths['cli'], *args],
+                    lines.append, self.idleTimeout, self.totalTimeout, stderr=subprocess.STDOUT, cwd=workspace)
+            if not owned.is_set():
+                print('### Job {} was reassigned, dropping its result.'.format(spec['id']))
+                return
+            if returncode:
+                self.__upload(spec['id'], 'result', data='\n'.join(lines[-50:]).encode(), returncode=returncode)
+                return
+            if 'keystore' not in spec['blobs']:
+                if os.path.exists(values['keystore']):
+                    self.__upload(spec['id'], 'keystore', path=values['keystore'])
+                else:
+                    print('### Job {} left no keystore to send back.'.format(spec['id']))
+            self.__upload(spec['id'], 'result', path=values['out'])
+            print('### Finished job {}.'.format(spec['id']))
+        finally:
+            stopped.set()
+            removeTree(workspace)
+
+    def __fetchBlobs(self, blobs, workspace):
+        '''Downloads the blobs missing from the cache, verifying their hashes. Only the tools are cached'''
+        paths = {}
+        items = []
+        for name, blob in blobs.items():
+            cached = name in ('cli', 'patches')
+            paths[name] = os.path.join(self.blobDir if cached else workspace, blob)
+            if not os.path.exists(paths[name]):
+                items.append(DownloadItem(
+                    '{}/blobs/{}'.format(self.url, blob), paths[name], digest='sha256:' + blob.split('.')[0]))
+        self.downloader.Fetch(items)
+        return paths
+
+    def __heartbeat(self, jobId, owned, stopped):
+        while not stopped.wait(self.heartbeatInterval):
+            try:
+                self.__request('POST', '/jobs/{}/heartbeat'.format(jobId), {'worker': self.name})
+            except urllib.error.HTTPError as e:
+                if e.code == 409:
+                    owned.clear()
+                    return
+            except OSError:
+                pass
+
+    def __upload(self, jobId, kind, path = None, data = None, returncode = 0):
+        '''Streams a file (or sends data) to the coordinator'''
+        digest = hashlib.sha256()
+        if path:
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+        else:
+            digest.update(data)
+        headers = {
+            'X-Worker': self.name,
+            'X-Exit-Code': str(returncode),
+            'X-Sha256': digest.hexdigest(),
+            'Content-Length': str(os.path.getsize(path) if path else len(data)),
+            'Content-Type': 'application/octet-stream'
+        }
+        if not path:
+            self.__request('PUT', '/jobs/{}/{}'.format(jobId, kind), body=data, headers=headers)
+            return
+        with open(path, 'rb') as file:
+            self.__request('PUT', '/jobs/{}/{}'.format(jobId, kind), body=file, headers=headers)
+
+    def __request(self, method, path, data = None, body = None, headers = None):
+        '''Sends a request to the coordinator, returning the decoded JSON reply (None if empty)'''
+        headers = dict(headers or {})
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        request = urllib.request.Request(self.url + path, data=body, headers=headers, method=method)
+        with urllib.request.urlopen(request, timeout=60) as response:
+            reply = response.read()
+        return json.loads(reply) if reply else None
@@ -0,0 +1,148 @@
+"""
+A small download engine for the tool assets: concurrent, resumable and verified.
+"""
+
+import hashlib
+import http.client
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+from util import backoffDelay
+
+
+class DownloadItem:
+    '''One file to download, with the size and digest it is expected to have'''
+
+    def __init__(self, url, path, size = None, digest = None):
+        self.url = url
+        self.path = path
+        self.size = size
+        # GitHub reports digests as "<algorithm>:<hex digest>"
+        self.digest = digest.split(':', 1) if digest else None
+
+    def __str__(self):
+        return os.path.basename(self.path)
+
+
+class Downloader:
+    '''Downloads files concurrently over pooled keep-alive connections.
+    Files are streamed to a ".part" file which is renamed into place once verified,
+    and an interrupted ".part" file is resumed with an HTTP range request.'''
+
+    userAgent = 'revanced-auto-patcher'
+
+    def __init__(self, workers = 4, chunkSize = 1 << 20, timeout = 60, retries = 2, retryDelay = 1, maxRetryDelay = 30,
+                 headers = None):
+        self.workers = workers
+        self.chunkSize = chunkSize
+        self.timeout = timeout
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+        self.headers = headers or {}
+        self.local = threading.local()
+
+    def Fetch(self, items):
+        '''Downloads all items, raising a RuntimeError listing those that failed'''
+        items = list(items)
+        if not items:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(items))) as pool:
+            results = list(pool.map(self.__fetchOne, items))
+        failures = [error for error in results if error]
+        if failures:
+            raise RuntimeError('Failed to download ' + '; '.join(failures))
+
+    def __fetchOne(self, item):
+        with metrics.Stage('tool-download', str(item)) as record:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(backoffDelay(attempt - 1, self.retryDelay, self.maxRetryDelay))
+                try:
+                    record.AddBytes(self.__download(item))
+                    return None
+                except (OSError, http.client.HTTPException, RuntimeError) as e:
+                    self.__dropConnections()
+                    error = '{}: {}'.format(item, e)
+            record['ok'] = False
+            return error
+
+    def __download(self, item):
+        '''Downloads one item, returning the number of bytes transferred'''
+        partPath = item.path + '.part'
+        offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+        if item.size is not None and offset > item.size:
+            offset = 0
+        response = self.__get(item.url, offset)
+        try:
+            if response.status == 416:
+                # The part file already holds the whole range
+                response.read()
+            elif response.status == 200:
+                offset = 0
+            elif response.status != 206:
+                raise RuntimeError('HTTP {} {}'.format(response.status, response.reason))
+
+            digest = hashlib.new(item.digest[0]) if item.digest else None
+            with open(partPath, 'r+b' if offset else 'wb') as file:
+                if digest and offset:
+                    for chunk in iter(lambda: file.read(self.chunkSize), b''):
+                        if file.tell() > offset:
+                            chunk = chunk[:len(chunk) - (file.tell() - offset)]
+                        digest.update(chunk)
+                file.seek(offset)
+                file.truncate()
+                if response.status != 416:
+                    for chunk in iter(lambda: response.read(self.chunkSize), b''):
+                        file.write(chunk)
+                        if digest:
+                            digest.update(chunk)
+                size = file.tell()
+                transferred = size - offset
+        finally:
+            response.close()
+
+        if item.size is not None and size != item.size:
+            if size > item.size or response.status == 416:
+                os.remove(partPath)
+            raise RuntimeError('size mismatch ({} instead of {} bytes)'.format(size, item.size))
+        if digest and digest.hexdigest() != item.digest[1]:
+            os.remove(partPath)
+            raise RuntimeError('{} digest mismatch'.format(item.digest[0]))
+        os.replace(partPath, item.path)
+        return transferred
+
+    def __get(self, url, offset, redirects = 5):
+        '''Sends a GET request on a pooled connection, following redirects'''
+        for _ in range(redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            connection = self.__connection(parts.scheme, parts.netloc)
+            headers = dict(self.headers, **{'User-Agent': self.userAgent, 'Accept': 'application/octet-stream'})
+            if offset:
+                headers['Range'] = 'bytes={}-'.format(offset)
+            target = parts.path + ('?' + parts.query if parts.query else '')
+            connection.request('GET', target, headers=headers)
+            response = connection.getresponse()
+            if response.status not in (301, 302, 303, 307, 308):
+                return response
+            response.read()
+            url = urllib.parse.urljoin(url, response.getheader('Location'))
+        raise RuntimeError('too many redirects')
+
+    def __connection(self, scheme, netloc):
+        '''Returns this thread's keep-alive connection to a host'''
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        key = (scheme, netloc)
+        if key not in self.local.connections:
+            connectionType = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            self.local.connections[key] = connectionType(netloc, timeout=self.timeout)
+        return self.local.connections[key]
+
+    def __dropConnections(self):
+        for connection in getattr(self.local, 'connections', {}).values():
+            connection.close()
+        self.local.connections = {}
@@ -0,0 +1,70 @@
+"""
+Access to GitHub release metadata, cached on disk between runs.
+"""
+
+import json
+import os
+import re
+import time
+import urllib.error
+import urllib.request
+from metrics import metrics
+from util import readJson, writeJson
+
+
+class ReleaseCache:
+    '''Caches GitHub release metadata, revalidating it with ETags once it is older than the TTL'''
+
+    def __init__(self, cacheDir, ttl = 3600, offline = False, apiUrl = 'https://api.github.com'):
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+        self.offline = offline
+        self.apiUrl = apiUrl.rstrip('/')
+
+    def Release(self, project, version = 'latest'):
+        '''Returns the release data of a project, or None if offline and it was never cached'''
+        if version != 'latest':
+            version = 'tags/v' + version.lstrip('v')
+        entryPath = self.__entryPath(project, version)
+        entry = readJson(entryPath)
+        if self.offline:
+            return entry['data'] if entry else None
+        if entry and time.time() - entry['fetched'] < self.ttl:
+            return entry['data']
+
+        request = urllib.request.Request(
+            '{}/repos/{}/releases/{}'.format(self.apiUrl, project, version),
+            headers={'Accept': 'application/vnd.github+json'})
+        if os.environ.get('GITHUB_TOKEN'):
+            request.add_header('Authorization', 'Bearer ' + os.environ['GITHUB_TOKEN'])
+        if entry and entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        with metrics.Stage('github-api', project) as record:
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    body = response.read()
+                    record.AddBytes(len(body))
+                    entry = {
+                        'etag': response.headers.get('ETag'),
+                        'data': json.loads(body)
+                    }
+            except urllib.error.HTTPError as e:
+                if e.code != 304:
+                    record['ok'] = False
+                    return self.__stale(project, entry, e)
+            except (urllib.error.URLError, OSError) as e:
+                record['ok'] = False
+                return self.__stale(project, entry, e)
+        entry['fetched'] = time.time()
+        writeJson(entryPath, entry)
+        return entry['data']
+
+    def __stale(self, project, entry, error):
+        '''Falls back to outdated metadata when GitHub can't be reached'''
+        if not entry:
+            raise RuntimeError('Could not get the releases of {}: {}'.format(project, error))
+        print('### Could not refresh the releases of {} ({}), using cached data.'.format(project, error))
+        return entry['data']
+
+    def __entryPath(self, project, version):
+        return os.path.join(self.cacheDir, re.sub(r'[^\w.-]', '_', '{}@{}'.format(project, version)) + '.json')
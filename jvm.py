@@ -0,0 +1,208 @@
+"""
+Optional warm JVM workers: long-lived processes that keep revanced-cli loaded and run
+its commands in-process, so batches don't pay JVM startup and class loading per app.
+"""
+
+import os
+import socket
+import subprocess
+import threading
+from resources import ProcessTimeout, Watchdog
+
+# A single-file Java program, started with "java RevancedWorker.java <cli jar>".
+# It loads the cli jar once, then runs each command received on its loopback socket
+# through picocli, streaming the output back and ending with "\0EXIT <code>".
+workerSource = r'''
+import java.io.*;
+import java.net.*;
+import java.nio.charset.StandardCharsets;
+import java.util.logging.*;
+
+public class RevancedWorker {
+    public static void main(String[] args) throws Exception {
+        URLClassLoader loader = new URLClassLoader(
+            new URL[] { new File(args[0]).toURI().toURL() }, RevancedWorker.class.getClassLoader());
+        Thread.currentThread().setContextClassLoader(loader);
+        Class<?> commandLine = loader.loadClass("picocli.CommandLine");
+        // MainCommand is a private Kotlin object, so its class and INSTANCE are not public
+        java.lang.reflect.Field instance = loader.loadClass("app.revanced.cli.command.MainCommand").getDeclaredField("INSTANCE");
+        instance.setAccessible(true);
+        Object mainCommand = instance.get(null);
+        PrintStream stdout = System.out, stderr = System.err;
+        ServerSocket server = new ServerSocket(0, 1, InetAddress.getLoopbackAddress());
+        stdout.println("PORT " + server.getLocalPort());
+        stdout.flush();
+        while (true) {
+            try (Socket socket = server.accept()) {
+                BufferedReader in = new BufferedReader(new InputStreamReader(socket.getInputStream(), StandardCharsets.UTF_8));
+                PrintStream out = new PrintStream(socket.getOutputStream(), true, "UTF-8");
+                String request = in.readLine();
+                if (request == null) continue;
+                if (request.equals("QUIT")) return;
+                if (request.equals("PING")) {
+                    out.println("PONG");
+                    continue;
+                }
+                Logger root = Logger.getLogger("");
+                for (Handler handler : root.getHandlers()) root.removeHandler(handler);
+                root.addHandler(new Handler() {
+                    public void publish(LogRecord record) {
+                        out.println(record.getLevel() + ": " + new SimpleFormatter().formatMessage(record));
+                    }
+                    public void flush() { out.flush(); }
+                    public void close() { }
+                });
+                System.setOut(out);
+                System.setErr(out);
+                int code;
+                try {
+                    Object command = commandLine.getConstructor(Object.class).newInstance(mainCommand);
+                    code = (Integer) commandLine.getMethod("execute", String[].class)
+                        .invoke(command, (Object) request.substring(4).split("\t"));
+                } catch (Throwable e) {
+                    e.printStackTrace(out);
+                    code = 1;
+                } finally {
+                    System.setOut(stdout);
+                    System.setErr(stderr);
+                }
+                out.println("\0EXIT " + code);
+            }
+        }
+    }
+}
+'''
+
+
+class WorkerError(RuntimeError):
+    '''The worker could not run a job, as opposed to the job itself failing'''
+
+
+class WorkerStartError(WorkerError):
+    '''The worker could not be started, as with a cli jar it can't load'''
+
+
+class JvmWorker:
+    '''One warm JVM running revanced-cli commands sent over a loopback socket'''
+
+    def __init__(self, cliPath, sourcePath, jvmArgs, recycleAfter, timeout = 60):
+        self.cliPath = cliPath
+        self.sourcePath = sourcePath
+        self.jvmArgs = jvmArgs
+        self.recycleAfter = recycleAfter
+        self.timeout = timeout
+        self.process = None
+        self.jobs = 0
+
+    def Run(self, args, onLine, idleTimeout = None, totalTimeout = None):
+        '''Runs a cli command, passing each output line to onLine. Returns the exit code.
+        Raises ProcessTimeout, restarting the worker, if the command exceeds the watchdog's limits.'''
+        if self.process and (self.jobs >= self.recycleAfter or not self.Healthy()):
+            # Recycle the JVM to contain leaks, or replace it if it stopped answering
+            self.Stop()
+        if not self.process:
+            self.__start()
+        self.jobs += 1
+        with Watchdog(self.process.kill, idleTimeout, totalTimeout) as watchdog:
+            try:
+                with socket.create_connection(('127.0.0.1', self.port), timeout=self.timeout) as connection:
+                    connection.settimeout(None)
+                    connection.sendall(('JOB ' + '\t'.join(str(i) for i in args) + '\n').encode('utf-8'))
+                    for line in connection.makefile('r', encoding='utf-8', errors='replace'):
+                        watchdog.Touch()
+                        line = line.rstrip('\n')
+                        if line.startswith('\0EXIT '):
+                            return int(line[6:])
+                        onLine(line)
+            except OSError as e:
+                error = e
+            else:
+                error = 'it exited during the job'
+        self.Stop()
+        if watchdog.reason:
+            raise ProcessTimeout('the JVM worker {}, so it was stopped'.format(watchdog.reason))
+        raise WorkerError('The JVM worker failed: {}'.format(error))
+
+    def Healthy(self):
+        '''Checks that the worker process is alive and answering'''
+        if not self.process or self.process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(('127.0.0.1', self.port), timeout=5) as connection:
+                connection.sendall(b'PING\n')
+                return connection.makefile('r').readline().strip() == 'PONG'
+        except OSError:
+            return False
+
+    def Stop(self):
+        if not self.process:
+            return
+        try:
+            with socket.create_connection(('127.0.0.1', self.port), timeout=5) as connection:
+                connection.sendall(b'QUIT\n')
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def __start(self):
+        self.process = subprocess.Popen(
+            ['java', *self.jvmArgs, self.sourcePath, self.cliPath],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True)
+        self.jobs = 0
+        # The first line announces the port, unless the worker fails to start
+        timer = threading.Timer(self.timeout, self.process.kill)
+        timer.start()
+        line = self.process.stdout.readline()
+        timer.cancel()
+        if not line.startswith('PORT '):
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+            raise WorkerStartError('The JVM worker could not be started.')
+        self.port = int(line.split()[1])
+        threading.Thread(target=self.process.stdout.read, daemon=True).start()
+
+
+class JvmPool:
+    '''A set of warm JVM workers, each running one job at a time. A worker keeps one cli jar loaded,
+    and is restarted with another one when a job needs it, so patch sources can share the pool.
+    If a worker fails to start, the pool stops trying, and its jobs run in new JVMs.'''
+
+    def __init__(self, workDir, size, jvmArgs, recycleAfter):
+        sourcePath = os.path.join(workDir, 'RevancedWorker.java')
+        with open(sourcePath, 'w') as file:
+            file.write(workerSource)
+        self.all = [JvmWorker(None, sourcePath, jvmArgs, recycleAfter) for _ in range(size)]
+        self.idle = list(self.all)
+        self.condition = threading.Condition()
+        self.startError = None
+
+    def Run(self, cliPath, args, onLine, idleTimeout = None, totalTimeout = None):
+        '''Runs a cli command on a free worker. Raises WorkerError if the worker failed,
+        and ProcessTimeout if the command hung'''
+        if self.startError:
+            raise self.startError
+        with self.condition:
+            while not self.idle:
+                self.condition.wait()
+            # Prefer a worker that has the jar loaded, then one that isn't running
+            worker = min(self.idle, key=lambda i: (i.cliPath != cliPath, i.process is not None))
+            self.idle.remove(worker)
+        try:
+            if worker.cliPath != cliPath:
+                worker.Stop()
+                worker.cliPath = cliPath
+            return worker.Run(args, onLine, idleTimeout, totalTimeout)
+        except WorkerStartError as e:
+            self.startError = e
+            raise
+        finally:
+            with self.condition:
+                self.idle.append(worker)
+                self.condition.notify()
+
+    def Close(self):
+        for worker in self.all:
+            worker.Stop()
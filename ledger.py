@@ -0,0 +1,94 @@
+"""
+A crash-safe record of batch runs, kept in SQLite, so an interrupted run can be resumed
+without downloading and patching again what already finished.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    finished REAL,
+    targets TEXT NOT NULL,
+    sources TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    target TEXT NOT NULL,
+    source TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    version TEXT,
+    apkPath TEXT,
+    outPath TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (run, target, source)
+);
+'''
+
+
+class Ledger:
+    '''Tracks the stage and artifacts of every job of a run. Each change is committed at once,
+    so the ledger reflects the progress of a run that was killed at any point.'''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(schema)
+
+    def StartRun(self, targets, sources):
+        '''Records a new run, returning its id'''
+        with self.lock:
+            return self.connection.execute(
+                'INSERT INTO runs (started, targets, sources) VALUES (?, ?, ?)',
+                (time.time(), json.dumps(targets), json.dumps(sources))).lastrowid
+
+    def UnfinishedRun(self):
+        '''Returns the id, targets and sources of the newest run that did not complete, or None'''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT * FROM runs WHERE finished IS NULL ORDER BY id DESC LIMIT 1').fetchone()
+        if not row:
+            return None
+        return row['id'], json.loads(row['targets']), json.loads(row['sources'])
+
+    def Jobs(self, run):
+        '''Returns the recorded jobs of a run as a map of (target, source) -> job row'''
+        with self.lock:
+            rows = self.connection.execute('SELECT * FROM jobs WHERE run = ?', (run,)).fetchall()
+        return {(row['target'], row['source']): dict(row) for row in rows}
+
+    def Update(self, run, target, source, **fields):
+        '''Records the stage or artifacts of a job, creating its entry if needed'''
+        fields['updated'] = time.time()
+        values = dict({'run': run, 'target': target, 'source': source, 'stage': 'queued'}, **fields)
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO jobs ({}) VALUES ({}) ON CONFLICT (run, target, source) DO UPDATE SET {}'.format(
+                    ', '.join(values), ', '.join('?' * len(values)),
+                    ', '.join('{0} = excluded.{0}'.format(i) for i in fields)),
+                tuple(values.values()))
+
+    def AddAttempt(self, run, target, source):
+        '''Counts one more try of a job's current stage'''
+        with self.lock:
+            self.connection.execute(
+                'UPDATE jobs SET attempts = attempts + 1, updated = ? WHERE run = ? AND target = ? AND source = ?',
+                (time.time(), run, target, source))
+
+    def FinishRun(self, run):
+        '''Marks a run as complete, so it is not resumed'''
+        with self.lock:
+            self.connection.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), run))
+
+    def Close(self):
+        with self.lock:
+            self.connection.close()
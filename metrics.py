@@ -0,0 +1,146 @@
+"""
+Timing instrumentation of the patcher's stages, exported as JSON lines and in the
+Prometheus textfile collector format.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class Record(dict):
+    '''The measurements of one stage run'''
+
+    def AddBytes(self, count):
+        self['bytes'] = self.get('bytes', 0) + count
+
+    def AddUsage(self, usage):
+        '''Adds the CPU time and peak memory of a finished subprocess'''
+        if not usage:
+            return
+        self['cpu'] = self.get('cpu', 0) + usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in kilobytes on Linux
+        self['rss'] = max(self.get('rss', 0), usage.ru_maxrss * 1024)
+
+
+class Metrics:
+    '''Collects per-stage measurements of a run'''
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.directory = None
+        self.runId = uuid.uuid4().hex[:12]
+        self.started = time.time()
+
+    def Configure(self, directory):
+        '''Sets the directory the metrics are exported to'''
+        self.directory = directory
+
+    @contextmanager
+    def Stage(self, stage, app = None, source = None):
+        '''Measures the wall time of a stage. The yielded record takes bytes, CPU time and peak memory'''
+        record = Record(run=self.runId, stage=stage, app=app, source=source, start=time.time(), ok=True)
+        begin = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record['ok'] = False
+            raise
+        finally:
+            record['wall'] = time.perf_counter() - begin
+            with self.lock:
+                self.records.append(record)
+
+    def History(self):
+        '''Returns the records of earlier runs'''
+        if not self.directory:
+            return []
+        records = []
+        try:
+            with open(os.path.join(self.directory, 'metrics.jsonl'), encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+        return records
+
+    def Export(self):
+        '''Appends the records collected since the last export to metrics.jsonl and rewrites the
+        Prometheus textfile. A long-running process exports once per run, each starting a new run.'''
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            records, self.records = self.records, []
+            started, self.started = self.started, time.time()
+            self.runId = uuid.uuid4().hex[:12]
+        with open(os.path.join(self.directory, 'metrics.jsonl'), 'a', encoding='utf-8') as file:
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+
+        totals = {}
+        for record in records:
+            labels = (record['stage'], record['app'] or '', record['source'] or '')
+            total = totals.setdefault(labels, {'seconds': 0, 'bytes': 0, 'cpu_seconds': 0, 'peak_rss_bytes': 0, 'failures': 0})
+            total['seconds'] += record['wall']
+            total['bytes'] += record.get('bytes', 0)
+            total['cpu_seconds'] += record.get('cpu', 0)
+            total['peak_rss_bytes'] = max(total['peak_rss_bytes'], record.get('rss', 0))
+            total['failures'] += not record['ok']
+        lines = [
+            '# HELP revanced_patcher_run_timestamp_seconds Start time of the last run.',
+            '# TYPE revanced_patcher_run_timestamp_seconds gauge',
+            'revanced_patcher_run_timestamp_seconds {:.0f}'.format(started),
+            '# HELP revanced_patcher_run_seconds Wall time of the last run.',
+            '# TYPE revanced_patcher_run_seconds gauge',
+            'revanced_patcher_run_seconds {:.3f}'.format(self.started - started)
+        ]
+        for name in ('seconds', 'bytes', 'cpu_seconds', 'peak_rss_bytes', 'failures'):
+            metric = 'revanced_patcher_stage_' + name
+            lines.append('# HELP {} Stage {} of the last run, per app and patch source.'.format(metric, name.replace('_', ' ')))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for (stage, app, source), total in sorted(totals.items()):
+                lines.append('{}{{stage="{}",app="{}",source="{}"}} {}'.format(
+                    metric, stage, Metrics.__escape(app), source, round(total[name], 3)))
+        promPath = os.path.join(self.directory, 'revanced_patcher.prom')
+        with open(promPath + '.tmp', 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(promPath + '.tmp', promPath)
+
+    def Summary(self):
+        '''Prints a table of the time, traffic and resources each stage took in this run'''
+        with self.lock:
+            records = list(self.records)
+        if not records:
+            return
+        stages = {}
+        for record in records:
+            stage = stages.setdefault(record['stage'], {'count': 0, 'wall': 0, 'bytes': 0, 'cpu': 0, 'rss': 0, 'failed': 0})
+            stage['count'] += 1
+            stage['wall'] += record['wall']
+            stage['bytes'] += record.get('bytes', 0)
+            stage['cpu'] += record.get('cpu', 0)
+            stage['rss'] = max(stage['rss'], record.get('rss', 0))
+            stage['failed'] += not record['ok']
+        print('### {:<16} {:>5} {:>10} {:>10} {:>10} {:>10} {:>6}'.format(
+            'Stage', 'Runs', 'Wall (s)', 'CPU (s)', 'MB', 'Peak MB', 'Failed'))
+        for name, stage in sorted(stages.items(), key=lambda i: -i[1]['wall']):
+            print('### {:<16} {:>5} {:>10.2f} {:>10.2f} {:>10.1f} {:>10.0f} {:>6}'.format(
+                name, stage['count'], stage['wall'], stage['cpu'],
+                stage['bytes'] / (1 << 20), stage['rss'] / (1 << 20), stage['failed']))
+        print('### Total run time: {:.2f} s'.format(time.time() - self.started))
+
+    @staticmethod
+    def __escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# The metrics of the current run
+metrics = Metrics()
@@ -1,290 +1,1335 @@
-#!/usr/bin/python3
-
-"""
-A python script to easily patch APKs with ReVanced or ReVanced Extended.
-To configure the script's behaviour, edit the default settings below, or run
-"python patch.py --help" to see the command-line argument interface help.
-"""
-
-import os
-import sys
-import argparse
-import glob
-import json
-import re
-import shutil
-import subprocess
-import tempfile
-import textwrap
-import urllib.request
-from pathlib import Path
-from info import patchSources, appMap
-from device import scriptDir ,settings
-
-class Patcher:
-    tools = ['cli', 'patches']
-
-    def __init__(self, args):
-        patchSourceData = patchSources[args.patchSrc]
-        self.outPrepend = patchSourceData['prepend']
-        self.outDir = args.outDir
-        Patcher.__ensureDirectory(self.outDir)
-        self.toolsDir = Path(args.toolsDir, patchSourceData['subdir'])
-        Patcher.__ensureDirectory(self.toolsDir)
-        self.optionsDir = args.optionsDir
-        Patcher.__ensureDirectory(self.optionsDir)
-        self.apks_untoched_Dir = Path(self.toolsDir.parent, "APKs")
-        Patcher.__ensureDirectory(self.apks_untoched_Dir)
-        self.apks_patched_Dir = Path(self.toolsDir.parent.parent, "Patched-APKs")
-        Patcher.__ensureDirectory(self.apks_patched_Dir)
-        self.keystorePath = args.keystore
-        Patcher.__ensureDirectory(os.path.dirname(self.keystorePath))
-        for tool in self.tools:
-            Patcher.__ensureTool(
-                self.toolsDir,
-                project=patchSourceData[tool]['proj'],
-                version=getattr(args, tool + '_version'),
-                content_type=patchSourceData[tool]['type'])
-            
-        self.toolPaths = {
-            i: glob.glob(os.path.join(self.toolsDir, '*{}*'.format(i)))[0] for i in self.tools
-        }
-        
-
-
-    @staticmethod
-    def CheckJava():
-        try:
-            result = subprocess.run(
-                ['java', '-XshowSettings', '-version'],
-                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
-            match = re.search(
-                r'java\.class\.version = (\d+)(?:\.\d+)+', result.stderr.decode('ascii', 'ignore'))
-            if (not match or int(match[1]) < 55):
-                print('### The installed java version is too old. Please update it.')
-                return False
-        except subprocess.CalledProcessError(e):
-            print('### Error running java! Please install it and make sure it is in the path.')
-            return False
-        return True
-
-    def Patch(self, srcPath, optionsPath = None):
-        srcFile = os.path.basename(srcPath)
-        outPath = os.path.join(self.outDir, self.outPrepend + srcFile)
-        #optionsFile = optionsPath if optionsPath else os.path.splitext(Patcher.__normalFileName(srcFile))[0] + '.json'
-        tempDir = os.path.join(tempfile.gettempdir(), 'revanced-resource-cache')
-        print('### Patching {}...'.format(srcFile))
-        print("srcPath: ", srcPath)
-
-        try:
-            subprocess.run(f'java -jar {self.toolPaths['cli']}  patch -p{ self.toolPaths['patches']} "{srcPath}"', cwd=self.apks_patched_Dir)
-            print('### Finished patching {} successfully!'.format(os.path.abspath(outPath)))
-            print('### Deleting Temporal Files......')
-            for file in self.apks_patched_Dir.iterdir():
-                if file.is_dir():
-                    shutil.rmtree(file)
-                elif file.suffix == '.keystore':
-                    file.unlink()
-        except subprocess.CalledProcessError:
-            print('### Failed to patch {}!'.format(srcFile))
-        try:
-            # Purge the temp directory after patching (the built-in purger likes to fail)
-            shutil.rmtree(tempDir)
-        except:
-            pass
-
-    def DownloadAndPatch(self, appId):
-        apkPath = self.Download(appId)
-        if apkPath:
-            self.Patch(apkPath, os.path.join(scriptDir, appId + '.json'))
-            #os.remove(apkPath)
-        try:
-            os.rmdir(os.path.dirname(apkPath))
-        except:
-            pass
-
-    def Download(self, appId): #DOWNLOAD THE APKs
-        self.__ensureApkmd()
-
-        appData = appMap[appId]
-        try:
-            appVer = self.__getAppVersion(appData['package'])
-        except subprocess.CalledProcessError:
-            print('### Error: The patcher could not be called.'.format(appId))
-            return None
-        except RuntimeError:
-            print('### Error: {} is not supported by the patcher.'.format(appId))
-            return None
-        apkmdConfig = {
-            'apps': [{
-                'outFile': '{} {}'.format(appId, appVer if appVer else 'latest'),
-                'org': appData['org'],
-                'repo': appData['repo'],
-                'arch': appData['arch'] if 'arch' in appData.keys() else settings['download']['arch'],
-                'dpi': appData['dpi'] if 'dpi' in appData.keys() else settings['download']['dpi']
-            }]
-        }
-        if appVer != None:
-            apkmdConfig['apps'][0].update({'version': appVer})
-
-        print('### Downloading {}...'.format(appId + (' ' + appVer if appVer else '')))
-
-        fd, configPath = tempfile.mkstemp(suffix='.json')
-        with os.fdopen(fd, 'w') as file:
-            json.dump(apkmdConfig, file)
-        try:
-            # Try downloading the correct arch version
-            subprocess.run(
-                [self.apkmdPath, configPath], cwd=self.apks_untoched_Dir,
-                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                check=True)
-            path = Path(self.apks_untoched_Dir, apkmdConfig['apps'][0]['outFile'] + '.apk')
-            if not Path(path).exists:
-                print('### Failed to find a correct version of {} or blocked by server!'.format(appId))
-                return None
-            return path
-        except subprocess.CalledProcessError:
-            print('### Failed to download {}!'.format(appId))
-            return None
-        finally:
-            os.remove(configPath)
-
-    def __getAppVersion(self, appPackage):
-        result = subprocess.run([
-            'java', '-jar',
-            self.toolPaths['cli'], 'list-patches',
-            '--filter-package-name=' + appPackage,
-            '--with-versions',
-            '--with-packages',
-            self.toolPaths['patches']
-        ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
-        output = result.stdout.decode('ascii', 'ignore')
-        if not appPackage in output:
-            raise RuntimeError("App unsupported by patcher.")
-        versions = re.findall(r'^\s*(\d+\.\d+(?:\.\d+)*)\s*$', output, re.MULTILINE)
-        versions = [tuple(map(int, x.split('.'))) for x in versions]
-        versions.sort(reverse=True)
-        if not versions:
-            return None
-        return '.'.join(str(x) for x in versions[0])
-
-    @staticmethod
-    def __ensureDirectory(directory):
-        '''Ensures that the path's directory exists'''
-        try:
-            os.makedirs(directory)
-        except FileExistsError:
-            pass
-
-    @staticmethod
-    def __normalFileName(path):
-        '''Removes version strings from the file name'''
-        regex = r'\b\s*v?\d+(?:\.\d+)*(?:-[^\s]*)?\b'
-        return re.sub(regex, '', path)
-
-    def __ensureApkmd(self):
-        if hasattr(self, 'apkmdPath'):
-            return
-        Patcher.__ensureTool(
-            self.toolsDir,
-            project='tanishqmanuja/apkmirror-downloader',
-            version='latest',
-            name_filter='apkmd.exe' if os.name == 'nt' else 'apkmd' if os.name == 'posix' else None
-        )
-        self.apkmdPath = glob.glob(os.path.join(self.toolsDir, 'apkmd*'))[0] #apkmd-2.0.8 path
-
-    #Download revanced-cli & patches & apkmd
-    @staticmethod
-    def __ensureTool(
-        directory, project, version = 'latest',
-        content_type = None, name_filter = None):
-        '''Prepares one ReVanced tool'''
-
-        def clearExistingTools(directory, assetName):
-            '''Deletes older versions of the given tool'''
-            regex = r'^([^\d]*)v?\d+(?:\.\d+(?:\.\d+)?)?[^\d]*(\.[^\.]+)$'
-            assetGlob = re.sub(regex, r'\1*\2', assetName)
-            for file in glob.glob(os.path.join(directory, assetGlob)):
-                os.remove(file)
-
-        if version != 'latest':
-            version = 'tags/v' + version.lstrip('v')
-        #TEMP 
-        url = 'https://api.github.com/repos/{0}/releases/{1}'.format(project, version)
-        releaseData = json.loads(urllib.request.urlopen(url).read())
-        for asset in releaseData['assets']:
-            if ((not content_type or asset['content_type'] == content_type) and
-                (not name_filter or re.match('^{}$'.format(name_filter), asset['name']))):
-                assetName = asset['name']
-                assetVer = releaseData['tag_name'].lstrip('v')
-                if assetVer not in assetName:
-                    assetName = os.path.splitext(assetName)
-                    assetName = ''.join((assetName[0], '-', assetVer, assetName[1]))
-                assetPath = os.path.join(directory, assetName)
-                if (not os.path.exists(assetPath)):
-                    print('### Downloading tool {}...'.format(assetName))
-                    Patcher.__ensureDirectory(directory)
-                    clearExistingTools(directory, assetName)
-                    assetUrl = asset['browser_download_url']
-                    urllib.request.urlretrieve(assetUrl, assetPath)
-
-def main():
-    
-    def argCheck(x):
-        arg = next((j for j, l in ((i, i.casefold()) for i in appMap.keys()) if l == x.casefold()), None)
-        if not arg: arg = x if os.path.exists(x) else None
-        if not arg: raise argparse.ArgumentTypeError("file or app not found: " + x)
-        return arg
-    
-    parser = argparse.ArgumentParser(
-        prog='ReVanced Auto Patcher',
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog=textwrap.dedent('''\
-            Selectable app names:
-                                    "{}"
-            '''.format('", "'.join(sorted(appMap.keys())))))
-    parser.add_argument('files or apps', 
-                        nargs='*',
-                        type=argCheck,
-                        default=glob.glob(os.path.join(settings['srcDir'], '*.apk')),
-                        help='One or more APK file to patch or app name(s) to download and patch.\n' +
-                            'Patching all APKs in the default source directory if unspecified.\n' +
-                            'See available app names below.')
-    parser.add_argument('--keystore', '-k', 
-                        default=os.path.abspath(settings['keystore']), 
-                        help='The path of the keystore file with which to sign the APKs (default: %(default)s)')
-    parser.add_argument('--optionsDir', 
-                        default=os.path.abspath(settings['optionsDir']), 
-                        help='The directory to store patch options files in (default: %(default)s)')
-    parser.add_argument('--outDir', '-o', 
-                        default=os.path.abspath(settings['outDir']), 
-                        help='The directory to write patched APKs to (default: %(default)s)')
-    parser.add_argument('--patchSrc', 
-                        choices=patchSources.keys(), 
-                        default=settings['defaultPatchSource'],
-                        type=lambda x : x if x in patchSources.keys() else raise_(argparse.ArgumentTypeError("invalid version")),
-                        help='The patch source to use. Use "rv" for ReVanced and "rvx" for ReVanced Extended (default: %(default)s).')
-    parser.add_argument('--toolsDir', 
-                        default=os.path.abspath(settings['toolsDir']), 
-                        help='The directory to store tools and patches in (default: %(default)s)')
-    
-    for tool in Patcher.tools:
-        parser.add_argument('--{}-version'.format(tool),
-                            type=lambda str : str if re.match(r'^latest|v?\d+(?:\.\d+)*(?:-[^ ]+)?$', str) else raise_(argparse.ArgumentTypeError("invalid version")),
-                            default=patchSources[settings['defaultPatchSource']][tool]['ver'], help='The tool version to use (default: %(default)s)')
-    args = parser.parse_args()
-
-    if not Patcher.CheckJava():
-        exit(1)
-
-    patcher = Patcher(args)
-    for path in getattr(args, 'files or apps'):
-        if path in appMap.keys():
-            patcher.DownloadAndPatch(path)
-        else:
-            patcher.Patch(path)
-
-
-
-if __name__ == "__main__":
+#!/usr/bin/python3
+
+"""
+A python script to easily patch APKs with ReVanced or ReVanced Extended.
+To configure the script's behaviour, edit the default settings below, or run
+"python patch.py --help" to see the command-line argument interface help.
+"""
+
+import os
+import sys
+import argparse
+import collections
+import glob
+import hashlib
+import json
+import re
+import shutil
+import subprocess
+import tempfile
+import textwrap
+import threading
+import time
+import queue
+import random
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from info import patchSources, appMap
+from device import scriptDir ,settings
+from apk import readApkInfo
+from cache import BuildCache, HashCache, ResourceCache
+from download import Downloader, DownloadItem
+from github import ReleaseCache
+from metrics import metrics
+from plan import Estimator, printPlan
+from jvm import JvmPool, WorkerError
+from ledger import Ledger
+from distributed import Coordinator, RemoteWorker
+from delta import makeDelta
+from store import ArtifactStore
+from progress import PatchProgress
+from resources import Governor, ProcessTimeout, runProcess, stoppingProcesses
+from util import readJson, writeJson, versionKey, replaceFile, removeTree, backoffDelay
+
+class Patcher:
+    tools = ['cli', 'patches']
+
+    def __init__(self, args, patchSrc, shared = None):
+        '''Sets up a patch source, whose tools are fetched when first needed. Patchers of several
+        sources share their caches and resource limits by passing the first one as shared.'''
+        patchSourceData = patchSources[patchSrc]
+        self.patchSrc = patchSrc
+        self.outPrepend = patchSourceData['prepend']
+        self.outDir = args.outDir
+        Patcher.__ensureDirectory(self.outDir)
+        self.toolsDir = Path(args.toolsDir, patchSourceData['subdir'])
+        Patcher.__ensureDirectory(self.toolsDir)
+        self.optionsDir = args.optionsDir
+        Patcher.__ensureDirectory(self.optionsDir)
+        self.apks_untoched_Dir = Path(self.toolsDir.parent, "APKs")
+        Patcher.__ensureDirectory(self.apks_untoched_Dir)
+        self.apks_patched_Dir = Path(self.toolsDir.parent.parent, "Patched-APKs")
+        Patcher.__ensureDirectory(self.apks_patched_Dir)
+        self.keystorePath = args.keystore
+        self.lock = threading.RLock()
+        self.workDir = Path(args.toolsDir, 'work')
+        Patcher.__ensureDirectory(self.workDir)
+        self.force = args.force
+        # Set to a distributed.Coordinator to run the patch jobs on remote workers
+        self.coordinator = None
+        if shared:
+            self.keystoreLock = shared.keystoreLock
+            self.resourceCache = shared.resourceCache
+            self.hashes = shared.hashes
+            self.builds = shared.builds
+            self.governor = shared.governor
+            self.store = shared.store
+            self.jvmPool = shared.jvmPool
+            self.workerHeap = shared.workerHeap
+        else:
+            self.keystoreLock = threading.Lock()
+            self.resourceCache = ResourceCache(
+                Path(args.toolsDir, 'cache', 'resources'), settings['resourceCacheMB'] << 20)
+            self.hashes = HashCache(Path(args.toolsDir, 'cache', 'hashes.json'))
+            self.builds = BuildCache(Path(self.apks_patched_Dir, '.builds'))
+            self.governor = Governor(settings['governor'], Path(args.toolsDir, 'cache', 'jvm-memory.json'))
+            self.store = ArtifactStore(
+                Path(args.toolsDir, 'store'), settings['store']['keepVersions'],
+                settings['store']['budgetMB'] << 20 if settings['store']['budgetMB'] else None, self.hashes.Hash)
+            # One pool of warm JVM workers for all patch sources, sized so that the workers fit the memory budget.
+            # The workers only start on first use.
+            self.workerHeap = self.governor.WorkerHeap(max(1, args.jobs))
+            self.jvmPool = JvmPool(
+                self.workDir, max(1, args.jobs), self.governor.JvmArgs(self.workerHeap),
+                settings['jvmRecycleAfter']) if args.daemon else None
+        Patcher.__ensureDirectory(os.path.dirname(self.keystorePath))
+        self.releases = ReleaseCache(
+            Path(args.toolsDir, 'cache', 'releases'),
+            ttl=args.cache_ttl,
+            offline=args.offline,
+            apiUrl=settings['githubApi'])
+        # Tools are looked up and downloaded on first use, so runs served from the caches need none
+        self.toolSpecs = {
+            tool: dict(
+                project=patchSourceData[tool]['proj'],
+                version=getattr(args, tool + '_version') or patchSourceData[tool]['ver'],
+                content_type=patchSourceData[tool]['type']) for tool in self.tools
+        }
+        self.toolSpecs['apkmd'] = dict(
+            project='tanishqmanuja/apkmirror-downloader',
+            version='latest',
+            name_filter='apkmd.exe' if os.name == 'nt' else 'apkmd' if os.name == 'posix' else None)
+        self.toolLock = threading.RLock()
+        self.resolvedTools = {}
+        self.toolPaths = {}
+
+    @staticmethod
+    def CheckJava(cachePath = None):
+        '''Checks that a recent enough java is installed. A successful check is cached by the path
+        and modification time of the java binary, so later runs don't start a JVM for it.'''
+        javaPath = shutil.which('java')
+        if not javaPath:
+            print('### Error running java! Please install it and make sure it is in the path.')
+            return False
+        javaPath = os.path.realpath(javaPath)
+        signature = [javaPath, os.stat(javaPath).st_mtime_ns]
+        if cachePath and readJson(cachePath, {}).get('java') == signature:
+            return True
+        try:
+            result = subprocess.run(
+                [javaPath, '-XshowSettings', '-version'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+            match = re.search(
+                r'java\.class\.version = (\d+)(?:\.\d+)+', result.stderr.decode('ascii', 'ignore'))
+            if (not match or int(match[1]) < 55):
+                print('### The installed java version is too old. Please update it.')
+                return False
+        except (subprocess.CalledProcessError, OSError):
+            print('### Error running java! Please install it and make sure it is in the path.')
+            return False
+        if cachePath:
+            writeJson(cachePath, {'java': signature})
+        return True
+
+    def OutPath(self, srcPath):
+        '''Returns the path the patched version of an APK is written to'''
+        return os.path.join(self.apks_patched_Dir, self.outPrepend + os.path.basename(srcPath))
+
+    def Patch(self, srcPath, app, optionsPath = None):
+        '''Patches an APK. The app (its id, or the package of an APK without an app entry, as returned by
+        CheckApk) keys its builds, deltas, heap history and stored artifacts.'''
+        srcFile = os.path.basename(srcPath)
+        outPath = self.OutPath(srcPath)
+        #optionsFile = optionsPath if optionsPath else os.path.splitext(Patcher.__normalFileName(srcFile))[0] + '.json'
+        appKey = app
+        with metrics.Stage('build-cache', appKey, self.patchSrc) as record:
+            apkHash = self.hashes.Hash(srcPath)
+            toolHashes = [self.__toolHash(i) for i in self.tools]
+            buildKey = self.__buildKey(apkHash, toolHashes, optionsPath)
+            record['hit'] = not self.force and self.builds.Restore(buildKey, outPath)
+        if record['hit']:
+            print('### {} is unchanged, reusing {}.'.format(srcFile, os.path.abspath(outPath)))
+            return True
+        print('### Patching {}...'.format(srcFile))
+        print("srcPath: ", srcPath)
+
+        toolPaths = self.__prepareTools(self.tools)
+        heap = self.governor.HeapSize(appKey, srcPath)
+        cacheKey = apkHash + '-' + Patcher.__toolsKey(toolPaths.values())[:16]
+        workspace = tempfile.mkdtemp(prefix='job-', dir=self.workDir)
+        success = False
+        try:
+            if self.coordinator:
+                with self.__keystoreGuard(), metrics.Stage('remote-patch', appKey, self.patchSrc) as record:
+                    returncode = self.coordinator.Run([
+                        'patch',
+                        '-p', '{patches}',
+                        '--out', '{out}',
+                        '--keystore', '{keystore}',
+                        '--temporary-files-path', '{tmp}',
+                        '{apk}'
+                    ], {
+                        name: (path, self.hashes.Hash(path)) for name, path in (
+                            ('cli', toolPaths['cli']),
+                            ('patches', toolPaths['patches']),
+                            ('apk', srcPath),
+                            ('keystore', self.keystorePath)
+                        ) if os.path.exists(path)
+                    }, heap, os.path.join(workspace, 'out.apk'), os.path.abspath(self.keystorePath))
+                    record['ok'] = returncode == 0
+            else:
+                returncode = self.__patchLocally(srcPath, workspace, cacheKey, heap, appKey, toolPaths['patches'])
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, 'java')
+            replaceFile(os.path.join(workspace, 'out.apk'), outPath)
+            # The patch creates the keystore if there was none, and the build is signed with it
+            buildKey = self.__buildKey(apkHash, toolHashes, optionsPath)
+            self.builds.Store(buildKey, outPath, self.patchSrc + ':' + appKey)
+            self.store.Add(outPath, 'patched', appKey, source=self.patchSrc, paths=[self.builds.ArtifactPath(buildKey)])
+            success = True
+            print('### Finished patching {} successfully!'.format(os.path.abspath(outPath)))
+            if settings['buildDeltas']:
+                self.__makeDelta(appKey, buildKey, outPath)
+        except subprocess.CalledProcessError:
+            print('### Failed to patch {}!'.format(srcFile))
+        except ProcessTimeout as e:
+            print('### Failed to patch {}: {}.'.format(srcFile, e))
+        finally:
+            removeTree(workspace)
+        return success
+
+    def __buildKey(self, apkHash, toolHashes, optionsPath):
+        return BuildCache.Key(apkHash, toolHashes, {
+            'prepend': self.outPrepend,
+            # A build signed with another key can't be installed as an update
+            'keystore': self.hashes.Hash(self.keystorePath) if os.path.exists(self.keystorePath) else None,
+            'options': self.hashes.Hash(optionsPath) if optionsPath and os.path.exists(optionsPath) else None
+        })
+
+    def __makeDelta(self, appKey, buildKey, outPath):
+        '''Writes the binary delta from the app's previous build to the new one into Patched-APKs/deltas'''
+        previousPath = self.builds.Previous(self.patchSrc + ':' + appKey, buildKey)
+        if not previousPath:
+            return
+        oldHash, newHash = self.hashes.Hash(previousPath), self.hashes.Hash(outPath)
+        if oldHash == newHash:
+            return
+        deltaPath = Path(self.apks_patched_Dir, 'deltas', '{}{} {}-{}.delta'.format(
+            self.outPrepend, appKey, oldHash[:12], newHash[:12]))
+        Patcher.__ensureDirectory(deltaPath.parent)
+        with metrics.Stage('delta', appKey, self.patchSrc) as record:
+            try:
+                makeDelta(previousPath, outPath, deltaPath)
+            except (OSError, ValueError) as e:
+                record['ok'] = False
+                print('### Could not make a delta from the previous build: {}'.format(e))
+                return
+            record.AddBytes(deltaPath.stat().st_size)
+        print('### Wrote {} ({:.1f} MB instead of {:.1f} MB).'.format(
+            deltaPath.name, deltaPath.stat().st_size / (1 << 20), os.path.getsize(outPath) / (1 << 20)))
+
+    def __patchLocally(self, srcPath, workspace, cacheKey, heap, appKey, patchesPath):
+        '''Runs the patch command on this machine, returning its exit code. Its progress is printed
+        as it goes, and its last output lines if it fails. Raises ProcessTimeout if it hung.'''
+        progress = PatchProgress(lambda event, detail: Patcher.__printProgress(appKey, progress, event, detail))
+        returncode = None
+        with self.resourceCache.Entry(cacheKey) as resourceDir, self.__keystoreGuard():
+            # A warm worker may use its whole heap, whatever the app needs
+            admitted = self.workerHeap if self.jvmPool else heap
+            with self.governor.Admit(admitted), metrics.Stage('patch', appKey, self.patchSrc) as record:
+                try:
+                    returncode, usage = self.__runCli([
+                        'patch',
+                        '-p', patchesPath,
+                        '--out', os.path.join(workspace, 'out.apk'),
+                        '--keystore', os.path.abspath(self.keystorePath),
+                        '--temporary-files-path', resourceDir or os.path.join(workspace, 'tmp'),
+                        os.path.abspath(srcPath)
+                    ], progress.Feed, heap, settings['watchdog']['patchSeconds'], cwd=workspace, stderr=subprocess.STDOUT)
+                finally:
+                    record['patchesApplied'] = progress.applied
+                    record['patchesFailed'] = len(progress.failed)
+                    if returncode != 0:
+                        print('### The last output of the patcher for {}:'.format(appKey))
+                        for line in progress.tail:
+                            print('    ' + line)
+                record.AddUsage(usage)
+                record['ok'] = returncode == 0
+                if returncode == 0:
+                    record.AddBytes(os.path.getsize(os.path.join(workspace, 'out.apk')))
+        self.governor.Record(appKey, usage, returncode == 0)
+        return returncode
+
+    @staticmethod
+    def __printProgress(appKey, progress, event, detail):
+        '''Prints the phases of a patch run, and the patches that failed'''
+        if event == 'failed':
+            print('### {}: the patch "{}" failed.'.format(appKey, detail))
+        elif event == 'phase' and (progress.applied or progress.failed):
+            print('### {}: {} ({} patches applied, {} failed)...'.format(appKey, detail, progress.applied, len(progress.failed)))
+        elif event == 'phase':
+            print('### {}: {}...'.format(appKey, detail))
+
+    def __runCli(self, args, onLine = None, heap = None, totalTimeout = None, **kwargs):
+        '''Runs a revanced-cli command, on a warm JVM worker if enabled, otherwise in a new JVM.
+        Output lines go to onLine if given. Returns the exit code and the resource usage
+        of the process (None for a worker). Raises ProcessTimeout if the watchdog stopped it.'''
+        idleTimeout = settings['watchdog']['idleSeconds']
+        cliPath = self.__tool('cli')
+        if self.jvmPool:
+            try:
+                return self.jvmPool.Run(cliPath, args, onLine or print, idleTimeout, totalTimeout), None
+            except WorkerError as e:
+                print('### {} Running the command in a new JVM instead.'.format(e))
+        jvmArgs = self.governor.JvmArgs(heap) if heap else []
+        return runProcess(['java', *jvmArgs, '-jar', cliPath, *args], onLine, idleTimeout, totalTimeout, **kwargs)
+
+    def Close(self):
+        '''Stops the warm JVM workers'''
+        if self.jvmPool:
+            self.jvmPool.Close()
+
+    @contextmanager
+    def __keystoreGuard(self):
+        '''Lets only one job run while the keystore doesn't exist yet, so it is created once'''
+        if os.path.exists(self.keystorePath):
+            yield
+            return
+        with self.keystoreLock:
+            yield
+
+    def ToolsKey(self):
+        '''Identifies the versions of the patch source's tools'''
+        return Patcher.__toolsKey(self.__toolAsset(i)[0] for i in self.tools)
+
+    @staticmethod
+    def __toolsKey(toolPaths):
+        '''Identifies a set of tool versions by their file names'''
+        return hashlib.sha256('\n'.join(sorted(os.path.basename(i) for i in toolPaths)).encode()).hexdigest()
+
+    def CheckApk(self, srcPath, appId = None):
+        '''Checks an APK against the supported versions and its app entry before patching it.
+        Returns the matching app name, or the APK's package if no app entry matches, raising ValueError
+        if the APK can't be patched.'''
+        info = readApkInfo(srcPath)
+        if appId and info.package != appMap[appId]['package']:
+            raise ValueError('{} is {}, not {}'.format(os.path.basename(srcPath), info.package, appId))
+        try:
+            versions = self.SupportedVersions(info.package)
+        except RuntimeError:
+            raise ValueError('{} is not supported by the patcher'.format(info.package))
+        if versions and info.versionName not in versions:
+            raise ValueError('{} {} is not a supported version (supported: {})'.format(
+                info.package, info.versionName, ', '.join(versions)))
+        appId = appId or next((i for i, j in appMap.items() if j['package'] == info.package), None)
+        arch = appMap[appId].get('arch', settings['download']['arch']) if appId else None
+        if info.abis and arch in ('armeabi-v7a', 'arm64-v8a', 'x86', 'x86_64') and arch not in info.abis:
+            print('### Warning: {} has no {} libraries (it has {}).'.format(
+                os.path.basename(srcPath), arch, ', '.join(info.abis)))
+        return appId or info.package
+
+    def IsSupported(self, appId):
+        '''Checks whether the patches support the app'''
+        return appMap[appId]['package'] in self.PatchIndex()
+
+    def Accepts(self, target):
+        '''Checks whether the patches support an app, or the package of an APK file'''
+        if target in appMap.keys():
+            return self.IsSupported(target)
+        try:
+            return readApkInfo(target).package in self.PatchIndex()
+        except ValueError:
+            # The preflight check reports why the file can't be patched
+            return True
+
+    def EnforceRetention(self):
+        '''Evicts the stored APKs, builds and tools beyond the retention settings'''
+        with metrics.Stage('retention') as record:
+            freed = self.store.Enforce()
+            record.AddBytes(freed)
+        if freed:
+            print('### Freed {:.1f} MB of old APKs, builds and tools.'.format(freed / (1 << 20)))
+
+    def PrintCacheStats(self):
+        '''Prints the build cache statistics'''
+        builds, size, hits, misses = self.builds.Stats()
+        print('### Build cache: {} builds, {:.1f} MB, {} hits, {} misses ({:.0%} hit rate).'.format(
+            builds, size / (1 << 20), hits, misses, hits / (hits + misses) if hits + misses else 0))
+
+    def Plan(self, targets, estimator, downloader = None, downloads = None):
+        '''Lists the actions a run of the targets would take with this patch source, with estimates of
+        their seconds and bytes from earlier runs. Only local files and cached metadata are read: nothing
+        is downloaded or changed, and no JVM is started. Returns dicts of source, target, action, detail,
+        seconds and bytes. As in a run, the APKs are downloaded by the downloader patcher, once for all
+        sources sharing the downloads set.'''
+        downloader = downloader or self
+        downloads = set() if downloads is None else downloads
+        tools = {name: self.__planTool(name) for name in self.tools}
+        toolHashes = {name: self.hashes.Hash(path) if path and os.path.exists(path) else digest
+                      for name, (path, digest, _, _) in tools.items()}
+        index = self.__cachedPatchIndex(toolHashes['patches']) if toolHashes['patches'] else None
+        actions, needed = [], set()
+
+        def add(target, action, detail = '', seconds = None, size = None, source = self.patchSrc):
+            actions.append({'source': source, 'target': target, 'action': action,
+                            'detail': detail, 'seconds': seconds, 'bytes': size})
+
+        if index is None:
+            needed.update(self.tools)
+            add('patches', 'index', 'list the patches and supported versions', estimator.Time('index', source=self.patchSrc))
+        for target in targets:
+            if target in appMap.keys():
+                label, appId, package = target, target, appMap[target]['package']
+                if index is not None and package not in index:
+                    add(label, 'skip', 'not supported by the patches')
+                    continue
+                versions = sorted(index[package]['versions'], key=versionKey, reverse=True) if index is not None else []
+                version = versions[0] if versions else None
+                srcPath = Path(self.apks_untoched_Dir, '{} {}.apk'.format(appId, version or 'latest'))
+                # A new download may be a different APK, so its build can't be looked up in the cache
+                fresh = not (version and srcPath.exists())
+                if not fresh:
+                    add(label, 'use APK', srcPath.name)
+                elif (appId, version) in downloads:
+                    add(label, 'use APK', '{} (downloaded above)'.format(version or 'newest version'))
+                else:
+                    downloads.add((appId, version))
+                    needed.add('apkmd')
+                    stored = [i for i in self.store.Artifacts() if i['kind'] == 'apk' and i['name'] == appId]
+                    size = (max(stored, key=lambda i: i['added'])['size'] if stored else
+                            estimator.Bytes('apkmd', source=self.patchSrc))
+                    add(label, 'download APK', version or ('newest version' if index is not None else 'version known after indexing'),
+                        estimator.DownloadTime('apkmd', size, source=self.patchSrc), size)
+            else:
+                label, srcPath, fresh = os.path.basename(target), target, False
+                try:
+                    info = readApkInfo(target)
+                except ValueError as e:
+                    add(label, 'skip', str(e))
+                    continue
+                if index is not None and info.package not in index:
+                    add(label, 'skip', '{} is not supported by the patches'.format(info.package))
+                    continue
+                versions = index[info.package]['versions'] if index is not None else None
+                if versions and info.versionName not in versions:
+                    add(label, 'skip', 'version {} is not supported'.format(info.versionName))
+                    continue
+                appId = next((i for i, j in appMap.items() if j['package'] == info.package), None)
+                package = info.package
+            appKey = appId or package
+            optionsPath = os.path.join(scriptDir, appId + '.json') if appId else None
+            outName = os.path.basename(self.OutPath(srcPath))
+            hashes = [toolHashes[i] for i in self.tools]
+            if (not fresh and all(hashes) and not self.force and
+                    self.builds.Contains(self.__buildKey(self.hashes.Hash(srcPath), hashes, optionsPath))):
+                add(label, 'reuse build', outName)
+                continue
+            needed.update(self.tools)
+            add(label, 'patch', outName, estimator.Time('patch', appKey, self.patchSrc),
+                estimator.Bytes('patch', appKey, self.patchSrc))
+            if settings['buildDeltas'] and self.builds.Previous(self.patchSrc + ':' + appKey, None):
+                add(label, 'delta', 'from the previous build', estimator.Time('delta', appKey, self.patchSrc),
+                    estimator.Bytes('delta', appKey, self.patchSrc))
+
+        # The tools come first, as the other actions wait for them
+        start = len(actions)
+        if 'apkmd' in needed and 'apkmd' not in downloads:
+            downloads.add('apkmd')
+            tools['apkmd'] = downloader.__planTool('apkmd')
+        for name, (path, _, state, size) in tools.items():
+            source = downloader.patchSrc if name == 'apkmd' else self.patchSrc
+            if name not in needed:
+                continue
+            if state == 'unknown':
+                add('tools', 'download', '{} (release not cached)'.format(self.toolSpecs[name]['project']),
+                    estimator.Time('tool-download'), source=source)
+            elif state == 'download':
+                add('tools', 'download', os.path.basename(path), estimator.DownloadTime('tool-download', size), size,
+                    source=source)
+            else:
+                add('tools', state, os.path.basename(path), source=source)
+        return actions[start:] + actions[:start]
+
+    def __planTool(self, name):
+        '''Returns how a tool would be prepared, without changing anything: its path and digest (None where
+        unknown), whether it would be used, restored from the store, downloaded or is unknown, and its size'''
+        spec = self.toolSpecs[name]
+        releaseData = self.releases.Release(spec['project'], spec['version'])
+        assets = Patcher.__toolAssets(
+            releaseData, self.toolsDir, spec.get('content_type'), spec.get('name_filter')) if releaseData else []
+        if len(assets) != 1:
+            # Without release metadata, a previously downloaded copy is used
+            try:
+                return self.__findTool(Patcher.__toolPattern(name)), None, 'use', None
+            except RuntimeError:
+                return None, None, 'unknown', None
+        path, digest, asset = assets[0]
+        if os.path.exists(path):
+            return path, digest, 'use', None
+        if self.store.Find('tool', os.path.basename(path)):
+            return path, digest, 'restore', None
+        return path, digest, 'download', asset.get('size')
+
+    def ListApps(self):
+        '''Prints the selectable apps supported by the patches'''
+        for appId in sorted(appMap.keys(), key=str.casefold):
+            package = appMap[appId]['package']
+            if package not in self.PatchIndex():
+                continue
+            versions = self.SupportedVersions(package)
+            print('{:<5} {:<28} {:<20} {}'.format(self.patchSrc, appId, versions[0] if versions else 'any', package))
+
+    def DownloadAll(self, appIds, versions = None):
+        '''Downloads the APKs of several apps with a single apkmd run.
+        The versions map can pin the version of an app, otherwise its newest supported version is used.
+        Returns a map of app -> downloaded APK path, or None where the app failed.'''
+        paths = dict.fromkeys(appIds)
+        pending = {}
+        for appId in appIds:
+            appData = appMap[appId]
+            try:
+                appVer = versions[appId] if versions and appId in versions else self.AppVersion(appId)
+            except subprocess.CalledProcessError:
+                print('### Error: The patcher could not be called.'.format(appId))
+                continue
+            except RuntimeError:
+                print('### Error: {} is not supported by the patcher.'.format(appId))
+                continue
+            if 'org' not in appData:
+                print('### Error: {} has no download source.'.format(appId))
+                continue
+            app = {
+                'outFile': '{} {}'.format(appId, appVer if appVer else 'latest'),
+                'org': appData['org'],
+                'repo': appData['repo'],
+                'arch': appData['arch'] if 'arch' in appData.keys() else settings['download']['arch'],
+                'dpi': appData['dpi'] if 'dpi' in appData.keys() else settings['download']['dpi']
+            }
+            if appVer != None:
+                app.update({'version': appVer})
+            path = Path(self.apks_untoched_Dir, app['outFile'] + '.apk')
+            if appVer and path.exists():
+                print('### Using the already downloaded {}.'.format(path.name))
+                paths[appId] = path
+                continue
+            pending[appId] = app
+            paths[appId] = path
+        if not pending:
+            return paths
+        # Only looked up now, so APKs that were already downloaded don't need apkmd
+        try:
+            apkmdPath = self.__tool('apkmd')
+        except RuntimeError as e:
+            print('### Error: {}'.format(e))
+            for appId in pending:
+                paths[appId] = None
+            return paths
+        for appId, app in pending.items():
+            print('### Downloading {}...'.format(appId + (' ' + app['version'] if 'version' in app else '')))
+            if paths[appId].exists():
+                # Unlink an older download instead of letting it be overwritten, as the store may share its storage
+                paths[appId].unlink()
+
+        output = collections.deque(maxlen=20)
+        fd, configPath = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as file:
+            json.dump({'apps': list(pending.values())}, file)
+        with metrics.Stage('apkmd', source=self.patchSrc) as record:
+            record['apps'] = len(pending)
+            try:
+                # Try downloading the correct arch version
+                returncode, usage = runProcess(
+                    [apkmdPath, configPath], output.append, settings['watchdog']['idleSeconds'],
+                    settings['watchdog']['downloadSeconds'], cwd=self.apks_untoched_Dir,
+                    stdin=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+                record.AddUsage(usage)
+                if returncode:
+                    # Some apps may still have been downloaded, those are checked below
+                    print('### The downloader reported errors:')
+                    for line in output:
+                        print('    ' + line)
+                    record['ok'] = False
+            except ProcessTimeout as e:
+                print('### Stopped downloading {}: {}.'.format(', '.join(pending), e))
+                record['ok'] = False
+                # The APK being written when the downloader was stopped can't be told apart, so none is kept
+                for appId in pending:
+                    if paths[appId].exists():
+                        paths[appId].unlink()
+            finally:
+                os.remove(configPath)
+            for appId, app in pending.items():
+                if not paths[appId].exists():
+                    print('### Failed to find a correct version of {} or blocked by server!'.format(appId))
+                    paths[appId] = None
+                else:
+                    record.AddBytes(paths[appId].stat().st_size)
+                    self.store.Add(paths[appId], 'apk', appId, app.get('version'))
+        return paths
+
+    def SupportedVersions(self, appPackage):
+        '''Lists the supported versions of a package, newest first. Empty if any version works'''
+        index = self.PatchIndex()
+        if appPackage not in index:
+            raise RuntimeError("App unsupported by patcher.")
+        return sorted(index[appPackage]['versions'], key=versionKey, reverse=True)
+
+    def PatchIndex(self):
+        '''Returns the package -> versions -> patches index of the patches artifact.
+        It is built with a single list-patches run and cached on disk by the artifact's hash.'''
+        with self.lock:
+            if not hasattr(self, 'patchIndex'):
+                self.patchIndex = self.__loadPatchIndex()
+        return self.patchIndex
+
+    def __loadPatchIndex(self):
+        patchesHash = self.__toolHash('patches')
+        packages = self.__cachedPatchIndex(patchesHash)
+        if packages is None:
+            patchesPath = self.__prepareTools(self.tools)['patches']
+            print('### Indexing {}...'.format(os.path.basename(patchesPath)))
+            lines = []
+            with metrics.Stage('index', source=self.patchSrc) as record:
+                returncode, usage = self.__runCli([
+                    'list-patches',
+                    '--with-versions',
+                    '--with-packages',
+                    patchesPath
+                ], lines.append, totalTimeout=settings['watchdog']['patchSeconds'], stderr=subprocess.DEVNULL)
+                record.AddUsage(usage)
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, 'java')
+            packages = Patcher.__parsePatchList('\n'.join(lines))
+            indexDir = Path(self.toolsDir, 'cache')
+            for file in indexDir.glob('patches-index-*.json'):
+                file.unlink()
+            writeJson(Path(indexDir, 'patches-index-{}.json'.format(patchesHash)), {
+                'hash': patchesHash,
+                'packages': packages
+            })
+        return packages
+
+    def __cachedPatchIndex(self, patchesHash):
+        '''Returns the index of the patches artifact with the given hash if it was built before, or None'''
+        index = readJson(Path(self.toolsDir, 'cache', 'patches-index-{}.json'.format(patchesHash)))
+        return index['packages'] if index and index.get('hash') == patchesHash else None
+
+    @staticmethod
+    def __parsePatchList(output):
+        '''Parses the output of list-patches into a package -> versions -> patches map'''
+        packages = {}
+        patch = package = None
+        versioned = False
+
+        def closePackage():
+            if package and not versioned:
+                packages[package]['any'].append(patch)
+
+        for line in output.splitlines():
+            indented = line[:1].isspace()
+            line = re.sub(r'^INFO:\s*', '', line.strip())
+            match = re.match(r'^Name:\s*(.+)$', line)
+            if match and not indented:
+                closePackage()
+                patch, package = match[1], None
+                continue
+            match = re.match(r'^Package name:\s*(\S+)$', line)
+            if match and patch:
+                closePackage()
+                package, versioned = match[1], False
+                packages.setdefault(package, {'versions': {}, 'any': []})
+                continue
+            match = re.match(r'^(\d+\.\d+(?:\.\d+)*)$', line)
+            if match and package:
+                versioned = True
+                packages[package]['versions'].setdefault(match[1], []).append(patch)
+        closePackage()
+        return packages
+
+    def AppVersion(self, appId):
+        '''Returns the newest supported version of an app, or None if any version works'''
+        versions = self.SupportedVersions(appMap[appId]['package'])
+        return versions[0] if versions else None
+
+    @staticmethod
+    def __ensureDirectory(directory):
+        '''Ensures that the path's directory exists'''
+        try:
+            os.makedirs(directory)
+        except FileExistsError:
+            pass
+
+    @staticmethod
+    def __normalFileName(path):
+        '''Removes version strings from the file name'''
+        regex = r'\b\s*v?\d+(?:\.\d+)*(?:-[^\s]*)?\b'
+        return re.sub(regex, '', path)
+
+    def __tool(self, name):
+        '''Returns the path of a tool, downloading it on first use'''
+        return self.__prepareTools([name])[name]
+
+    def __prepareTools(self, names):
+        '''Downloads the given tools where needed, all missing ones at the same time. Returns their paths'''
+        self.__resolveTools(names)
+        with self.toolLock:
+            missing = [i for i in names if i not in self.toolPaths]
+            items = [item for i in missing for item in self.resolvedTools[i][1]]
+            if items:
+                with metrics.Stage('tools', source=self.patchSrc):
+                    Patcher.__fetchTools(items, self.store, self.patchSrc)
+            for name in missing:
+                self.toolPaths[name] = self.__findTool(Patcher.__toolPattern(name))
+            if 'apkmd' in missing and not os.access(self.toolPaths['apkmd'], os.X_OK):
+                os.chmod(self.toolPaths['apkmd'], os.stat(self.toolPaths['apkmd']).st_mode | 0o111)
+            return {i: self.toolPaths[i] for i in names}
+
+    def __resolveTools(self, names):
+        '''Looks up the releases of the given tools once, querying GitHub for all of them at the same time'''
+        with self.toolLock:
+            names = [i for i in names if i not in self.resolvedTools]
+            if not names:
+                return
+            with ThreadPoolExecutor(len(names)) as pool:
+                resolved = list(pool.map(lambda name: Patcher.__resolveTool(
+                    self.releases, self.toolsDir, self.store, self.patchSrc, **self.toolSpecs[name]), names))
+            self.resolvedTools.update(zip(names, resolved))
+
+    def __toolAsset(self, name):
+        '''Returns the path and published SHA-256 digest of a tool's release, without downloading it.
+        Offline without release metadata, the downloaded copy of the tool is used.'''
+        self.__resolveTools([name])
+        assets = self.resolvedTools[name][0]
+        if len(assets) == 1:
+            return assets[0]
+        return self.__tool(name), None
+
+    def __toolHash(self, name):
+        '''Returns the SHA-256 hash of a tool. Until the tool is downloaded the digest published with
+        its release is used, so cached builds and patch indexes are found without downloading it.'''
+        path, digest = self.__toolAsset(name)
+        if digest and not os.path.exists(path):
+            return digest
+        return self.hashes.Hash(self.__tool(name))
+
+    @staticmethod
+    def __toolPattern(name):
+        return 'apkmd*' if name == 'apkmd' else '*{}*'.format(name)
+
+    def __findTool(self, pattern):
+        '''Finds a downloaded tool in the tools directory'''
+        paths = [i for i in glob.glob(os.path.join(self.toolsDir, pattern)) if not i.endswith('.part')]
+        if not paths:
+            raise RuntimeError('No tool matching {} in {}.'.format(pattern, self.toolsDir))
+        return paths[0]
+
+    #Download revanced-cli & patches & apkmd
+    @staticmethod
+    def __resolveTool(
+        releases, directory, store, source, project, version = 'latest',
+        content_type = None, name_filter = None):
+        '''Returns the (path, SHA-256 digest) of the release assets of one ReVanced tool, and the downloads
+        needed to prepare it. Versions kept in the store are restored from it.'''
+        releaseData = releases.Release(project, version)
+        if releaseData is None:
+            # Offline without cached metadata: any previously downloaded copy will do
+            return [], []
+        assets = Patcher.__toolAssets(releaseData, directory, content_type, name_filter)
+        items = []
+        for assetPath, _, asset in assets:
+            if (not os.path.exists(assetPath)):
+                assetName = os.path.basename(assetPath)
+                stored = store.Find('tool', assetName)
+                if stored and store.Checkout(stored['hash'], assetPath):
+                    print('### Restored tool {} from the store.'.format(assetName))
+                    Patcher.__retireOlderTools(assetPath, store, source)
+                    continue
+                if releases.offline:
+                    raise RuntimeError('{} is not available offline.'.format(assetName))
+                items.append(DownloadItem(
+                    asset['browser_download_url'], assetPath,
+                    size=asset.get('size'), digest=asset.get('digest')))
+        return [(assetPath, digest) for assetPath, digest, _ in assets], items
+
+    @staticmethod
+    def __toolAssets(releaseData, directory, content_type = None, name_filter = None):
+        '''Returns the local path, SHA-256 digest and release asset of each file of a tool release'''
+        assets = []
+        for asset in releaseData['assets']:
+            if ((not content_type or asset['content_type'] == content_type) and
+                (not name_filter or re.match('^{}$'.format(name_filter), asset['name']))):
+                assetName = asset['name']
+                assetVer = releaseData['tag_name'].lstrip('v')
+                if assetVer not in assetName:
+                    assetName = os.path.splitext(assetName)
+                    assetName = ''.join((assetName[0], '-', assetVer, assetName[1]))
+                assets.append((os.path.join(directory, assetName),
+                               (asset.get('digest') or '').partition('sha256:')[2] or None, asset))
+        return assets
+
+    @staticmethod
+    def __fetchTools(items, store, source):
+        '''Downloads tools concurrently, then moves their older versions into the store'''
+        for item in items:
+            print('### Downloading tool {}...'.format(item))
+            Patcher.__ensureDirectory(os.path.dirname(item.path))
+        Downloader(workers=settings['downloadWorkers'], retries=settings['downloadRetries'],
+                   retryDelay=settings['retryDelay'], maxRetryDelay=settings['maxRetryDelay']).Fetch(items)
+        for item in items:
+            Patcher.__retireOlderTools(item.path, store, source)
+
+    @staticmethod
+    def __retireOlderTools(assetPath, store, source):
+        '''Removes older versions of the given tool from the tools directory, keeping them in the store for a rollback'''
+        regex = r'^([^\d]*)v?\d+(?:\.\d+(?:\.\d+)?)?[^\d]*(\.[^\.]+)$'
+        assetGlob = re.sub(regex, r'\1*\2', os.path.basename(assetPath))
+        for file in glob.glob(os.path.join(os.path.dirname(assetPath), assetGlob)):
+            if file.endswith('.part'):
+                continue
+            store.Add(file, 'tool', assetGlob, source=source)
+            if file != assetPath:
+                os.remove(file)
+
+class Job:
+    '''One app or APK file to patch with one patch source, and how far it got'''
+
+    def __init__(self, target, patcher):
+        self.target = target
+        self.patcher = patcher
+        self.appId = target if target in appMap.keys() else None
+        self.apkPath = None if self.appId else target
+        self.version = None
+        self.stage = 'queued'
+        self.success = False
+        # Why the job was not run, when its patch source can't patch the target
+        self.skipped = None
+
+    def __str__(self):
+        return '{} ({})'.format(self.appId or os.path.basename(self.target), self.patcher.patchSrc)
+
+
+class Scheduler:
+    '''Runs the download and patch stages as a pipeline.
+    Download batches and patch jobs run on separate worker pools with their own concurrency,
+    connected by a bounded queue, so APKs are patched while others are still downloading.
+    With several patch sources, each distinct app version is downloaded once and patched by
+    every source that supports it, and the other sources skip it. With a ledger, the progress of every job is recorded, and
+    the jobs of a resumed run continue from the last stage they completed.'''
+
+    def __init__(self, patchers, patchJobs = 1, downloadJobs = 1, batchSize = 4, ledger = None, run = None):
+        self.patchers = patchers
+        self.patchJobs = max(1, patchJobs)
+        self.downloadJobs = max(1, downloadJobs)
+        self.batchSize = max(1, batchSize)
+        self.patchQueue = queue.Queue(maxsize=self.patchJobs * 2)
+        self.ledger = ledger
+        self.run = run
+        # Set when the run is interrupted, so the workers stop taking new work
+        self.stopped = threading.Event()
+
+    def Run(self, targets):
+        '''Processes all targets with every patch source that supports them, returning their jobs'''
+        jobs = [Job(i, patcher) for i in targets for patcher in self.patchers]
+        recorded = self.ledger.Jobs(self.run) if self.ledger else {}
+        downloads = {}
+        for job in jobs:
+            try:
+                accepted = job.patcher.Accepts(job.target)
+            except (RuntimeError, subprocess.CalledProcessError):
+                # The failure shows up again below, at the stage that needs the patches
+                accepted = True
+            if not accepted:
+                job.skipped = 'not supported by the {} patches'.format(job.patcher.patchSrc)
+                self.__advance(job, 'skipped', error=job.skipped)
+                continue
+            entry = recorded.get((job.target, job.patcher.patchSrc))
+            if entry and entry['stage'] == 'skipped':
+                # Rejected for good by an earlier attempt of this run
+                print('### {} was skipped by this run: {}.'.format(job, entry['error']))
+                job.stage, job.skipped = 'skipped', entry['error']
+                continue
+            if entry and entry['stage'] == 'done' and entry['outPath'] and os.path.exists(entry['outPath']):
+                print('### {} was already finished by this run.'.format(job))
+                job.stage, job.success = 'done', True
+                continue
+            if entry and entry['apkPath'] and os.path.exists(entry['apkPath']):
+                # Downloaded before the run was interrupted
+                job.version, job.apkPath = entry['version'], entry['apkPath']
+                continue
+            self.__advance(job, job.stage)
+            if job.appId:
+                self.__advance(job, 'resolve')
+                try:
+                    job.version = job.patcher.AppVersion(job.appId)
+                except (RuntimeError, subprocess.CalledProcessError):
+                    print('### Error: {} is not supported by the patcher.'.format(job))
+                    self.__advance(job, 'resolve', error='unsupported')
+                    continue
+                self.__advance(job, 'download', version=job.version)
+                downloads.setdefault((job.appId, job.version), []).append(job)
+        batches = queue.Queue()
+        for batch in Scheduler.__batches(list(downloads.items()), self.batchSize):
+            batches.put(batch)
+
+        # Taken before the downloads start, as they set the apkPath of the jobs they queue themselves
+        ready = [i for i in jobs if i.apkPath and not i.success and not i.skipped]
+        patchers = [Scheduler.__start(self.__patchWorker) for _ in range(self.patchJobs)]
+        downloaders = [Scheduler.__start(self.__downloadWorker, batches)
+                       for _ in range(min(self.downloadJobs, batches.qsize()))]
+        try:
+            for job in ready:
+                self.patchQueue.put(job)
+            for done in downloaders:
+                done.wait()
+            for _ in patchers:
+                self.patchQueue.put(None)
+            for done in patchers:
+                done.wait()
+        except BaseException:
+            # Interrupted (by Ctrl+C): the patchers and downloaders run in sessions of their own,
+            # so they are killed here, and the workers finish the jobs they had as failed
+            print('### Stopping the running jobs...')
+            self.stopped.set()
+            with stoppingProcesses():
+                for done in downloaders:
+                    done.wait()
+                for _ in patchers:
+                    self.patchQueue.put(None)
+                for done in patchers:
+                    done.wait()
+            raise
+        return jobs
+
+    @staticmethod
+    def Report(jobs):
+        '''Prints the outcome of every job, returning whether all that were not skipped succeeded'''
+        failed = [i for i in jobs if not i.success and not i.skipped]
+        skipped = [i for i in jobs if i.skipped]
+        print('### Finished: {} patched, {} failed, {} skipped.'.format(
+            len(jobs) - len(failed) - len(skipped), len(failed), len(skipped)))
+        for job in skipped:
+            print('###   {} was skipped: {}.'.format(job, job.skipped))
+        for job in failed:
+            print('###   {} failed at the {} stage.'.format(job, job.stage))
+        if failed:
+            print('### Run "python patch.py --resume" to retry only the failed jobs.')
+        return not failed
+
+    @staticmethod
+    def __start(target, *args):
+        '''Starts a worker thread, returning an event set once it ended. Unlike Thread.join, waiting for the
+        event can be interrupted and waited for again (an interrupted join marks a thread as ended).'''
+        done = threading.Event()
+
+        def run():
+            try:
+                target(*args)
+            finally:
+                done.set()
+        threading.Thread(target=run).start()
+        return done
+
+    def __advance(self, job, stage, **fields):
+        '''Moves a job to a stage, recording it and any new artifacts in the ledger'''
+        job.stage = stage
+        if self.ledger:
+            self.ledger.Update(self.run, job.target, job.patcher.patchSrc, stage=stage, **fields)
+
+    @staticmethod
+    def __batches(downloads, batchSize):
+        '''Splits the downloads into batches, keeping different versions of an app in different batches'''
+        while downloads:
+            batch, apps, rest = [], set(), []
+            for download in downloads:
+                if len(batch) < batchSize and download[0][0] not in apps:
+                    batch.append(download)
+                    apps.add(download[0][0])
+                else:
+                    rest.append(download)
+            yield batch
+            downloads = rest
+
+    def __downloadWorker(self, batches):
+        while True:
+            try:
+                batch = batches.get_nowait()
+            except queue.Empty:
+                return
+            # Failed downloads are often transient (rate limits, dropped connections), so they are retried
+            for attempt in range(settings['downloadRetries'] + 1):
+                if self.stopped.is_set():
+                    return
+                if attempt:
+                    delay = backoffDelay(attempt - 1, settings['retryDelay'], settings['maxRetryDelay'])
+                    print('### Retrying the download of {} in {:.0f} s...'.format(
+                        ', '.join(appId for (appId, _), _ in batch), delay))
+                    if self.stopped.wait(delay):
+                        return
+                if self.ledger:
+                    for _, jobs in batch:
+                        for job in jobs:
+                            self.ledger.AddAttempt(self.run, job.target, job.patcher.patchSrc)
+                try:
+                    paths = self.patchers[0].DownloadAll(
+                        [appId for (appId, _), _ in batch],
+                        versions={appId: version for (appId, version), _ in batch})
+                except Exception as e:
+                    print('### Error: {}'.format(e))
+                    paths = {}
+                for (appId, _), jobs in batch:
+                    for job in jobs:
+                        job.apkPath = paths.get(appId)
+                        if job.apkPath:
+                            self.__advance(job, 'download', apkPath=str(job.apkPath), error=None)
+                            self.patchQueue.put(job)
+                        else:
+                            self.__advance(job, 'download', error='download failed')
+                batch = [i for i in batch if not paths.get(i[0][0])]
+                if not batch:
+                    break
+
+    def __patchWorker(self):
+        while True:
+            job = self.patchQueue.get()
+            if job is None:
+                return
+            if self.stopped.is_set():
+                # Left for a resumed run
+                continue
+            try:
+                self.__advance(job, 'preflight', apkPath=str(job.apkPath))
+                try:
+                    with metrics.Stage('preflight', job.appId, job.patcher.patchSrc):
+                        app = job.patcher.CheckApk(job.apkPath, job.appId)
+                except ValueError as e:
+                    # Trying again would not change the APK, so the job is not resumed
+                    print('### Skipping {}: {}.'.format(job, e))
+                    job.skipped = str(e)
+                    self.__advance(job, 'skipped', error=job.skipped)
+                    continue
+                self.__advance(job, 'patch')
+                job.success = job.patcher.Patch(
+                    job.apkPath, app,
+                    os.path.join(scriptDir, app + '.json') if app in appMap else None)
+                if job.success:
+                    self.__advance(job, 'done', outPath=job.patcher.OutPath(job.apkPath), error=None)
+                else:
+                    self.__advance(job, 'patch', error='patch failed')
+            except Exception as e:
+                print('### Error: {}'.format(e))
+                self.__advance(job, job.stage, error=str(e))
+
+class Watcher:
+    '''Polls for new tool releases and newly supported app versions, rebuilding only the targets
+    that changed. The release metadata is revalidated with conditional requests, so an unchanged
+    poll costs a few HTTP round trips, and the state of every target's last successful build is
+    kept on disk between polls and restarts.'''
+
+    def __init__(self, args, targets, ledger, coordinator = None):
+        self.args = args
+        self.targets = targets
+        self.ledger = ledger
+        self.coordinator = coordinator
+        self.statePath = Path(args.toolsDir, 'cache', 'watch.json')
+        self.state = readJson(self.statePath, {})
+
+    def Run(self, interval, jitter):
+        '''Polls until interrupted, waiting a randomized interval between polls'''
+        while True:
+            try:
+                self.Poll()
+            except Exception as e:
+                # Whatever went wrong may be gone by the next poll
+                print('### Error: {}'.format(e))
+            delay = interval * random.uniform(1 - jitter, 1 + jitter)
+            print('### Checking again at {}.'.format(time.strftime('%H:%M:%S', time.localtime(time.time() + delay))))
+            time.sleep(delay)
+
+    def Poll(self):
+        '''Checks every target once, rebuilding those whose version or tools changed. Returns them'''
+        patchers = createPatchers(self.args, self.coordinator)
+        try:
+            with metrics.Stage('watch'):
+                current = {}
+                for patcher in patchers:
+                    toolsKey = patcher.ToolsKey()
+                    for target in self.targets:
+                        if target not in appMap.keys() and not os.path.exists(target):
+                            continue
+                        if not patcher.Accepts(target):
+                            continue
+                        if target in appMap.keys():
+                            version = patcher.AppVersion(target)
+                        else:
+                            version = patcher.hashes.Hash(target)
+                        current.setdefault(target, {})[patcher.patchSrc] = [version, toolsKey]
+            changed = [i for i in self.targets if i in current and current[i] != self.state.get(i)]
+            if not changed:
+                print('### Nothing changed.')
+                return []
+            print('### Rebuilding {}.'.format(', '.join(changed)))
+            run = self.ledger.StartRun(changed, self.args.patchSrc)
+            scheduler = Scheduler(patchers, patchJobs=self.args.jobs, downloadJobs=self.args.download_jobs,
+                                  batchSize=settings['downloadBatchSize'], ledger=self.ledger, run=run)
+            jobs = scheduler.Run(changed)
+            patchers[0].EnforceRetention()
+            metrics.Summary()
+            if Scheduler.Report(jobs):
+                self.ledger.FinishRun(run)
+            # Failed targets keep their old state, so the next poll tries them again. Only the sources
+            # supporting a target count, and its skipped jobs won't change until the target does.
+            for target in changed:
+                if all(job.success or job.skipped for job in jobs
+                       if job.target == target and job.patcher.patchSrc in current[target]):
+                    self.state[target] = current[target]
+            writeJson(self.statePath, self.state)
+            return changed
+        finally:
+            for patcher in patchers:
+                patcher.Close()
+            metrics.Export()
+
+def createPatchers(args, coordinator = None):
+    '''Creates a patcher for every selected patch source.
+    With a coordinator, the patchers hand their patch jobs to remote workers.'''
+    patchers = []
+    try:
+        for patchSrc in args.patchSrc:
+            patchers.append(Patcher(args, patchSrc, patchers[0] if patchers else None))
+            patchers[-1].coordinator = coordinator
+    except RuntimeError:
+        for patcher in patchers:
+            patcher.Close()
+        raise
+    return patchers
+
+def main():
+    
+    def argCheck(x):
+        arg = next((j for j, l in ((i, i.casefold()) for i in appMap.keys()) if l == x.casefold()), None)
+        if not arg: arg = x if os.path.exists(x) else None
+        if not arg: raise argparse.ArgumentTypeError("file or app not found: " + x)
+        return arg
+
+    def patchSrcCheck(x):
+        sources = [i.strip() for i in x.split(',') if i.strip()]
+        invalid = [i for i in sources if i not in patchSources.keys()]
+        if not sources or invalid:
+            raise argparse.ArgumentTypeError('invalid patch source: {} (choose from {})'.format(
+                ', '.join(invalid) or x, ', '.join(patchSources.keys())))
+        return list(dict.fromkeys(sources))
+
+    def versionCheck(x):
+        if not re.match(r'^latest|v?\d+(?:\.\d+)*(?:-[^ ]+)?$', x):
+            raise argparse.ArgumentTypeError('invalid version: ' + x)
+        return x
+    
+    parser = argparse.ArgumentParser(
+        prog='ReVanced Auto Patcher',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent('''\
+            Selectable app names:
+                                    "{}"
+            '''.format('", "'.join(sorted(appMap.keys())))))
+    parser.add_argument('files or apps', 
+                        nargs='*',
+                        type=argCheck,
+                        help='One or more APK file to patch or app name(s) to download and patch.\n' +
+                            'Patching all APKs in the default source directory if unspecified.\n' +
+                            'See available app names below.')
+    parser.add_argument('--keystore', '-k', 
+                        default=os.path.abspath(settings['keystore']), 
+                        help='The path of the keystore file with which to sign the APKs (default: %(default)s)')
+    parser.add_argument('--optionsDir', 
+                        default=os.path.abspath(settings['optionsDir']), 
+                        help='The directory to store patch options files in (default: %(default)s)')
+    parser.add_argument('--outDir', '-o', 
+                        default=os.path.abspath(settings['outDir']), 
+                        help='The directory to write patched APKs to (default: %(default)s)')
+    parser.add_argument('--patchSrc', 
+                        default=[settings['defaultPatchSource']],
+                        type=patchSrcCheck,
+                        help='The patch source to use. Use "rv" for ReVanced and "rvx" for ReVanced Extended (default: %(default)s). ' +
+                            'Separate several sources with commas, like "rv,rvx", to build every app with each of them.')
+    parser.add_argument('--toolsDir', 
+                        default=os.path.abspath(settings['toolsDir']), 
+                        help='The directory to store tools and patches in (default: %(default)s)')
+    parser.add_argument('--offline',
+                        action='store_true',
+                        help='Use only cached release metadata and already downloaded tools, without contacting GitHub.')
+    parser.add_argument('--cache-ttl',
+                        type=int,
+                        default=settings['releaseCacheTtl'],
+                        help='Seconds for which cached GitHub release metadata is used without revalidation (default: %(default)s)')
+    parser.add_argument('--jobs', '-j',
+                        type=int,
+                        default=settings['patchJobs'],
+                        help='The number of APKs patched at the same time (default: %(default)s)')
+    parser.add_argument('--download-jobs',
+                        type=int,
+                        default=settings['downloadJobs'],
+                        help='The number of APK download batches run at the same time (default: %(default)s)')
+    parser.add_argument('--force', '-f',
+                        action='store_true',
+                        help='Patch APKs again even if an identical build is cached.')
+    parser.add_argument('--cache-stats',
+                        action='store_true',
+                        help='Print build cache statistics, then exit.')
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        default=settings['jvmDaemon'],
+                        help='Run the patcher on warm, long-lived JVM workers instead of starting a JVM per command.')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Continue the last unfinished run with its apps and patch sources, skipping the work it already finished.')
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help='Keep running, and rebuild the apps whenever the patches or the apps\' supported versions change.')
+    parser.add_argument('--watch-interval',
+                        type=int,
+                        default=settings['watchInterval'],
+                        help='Seconds between the checks for changes in watch mode (default: %(default)s)')
+    parser.add_argument('--serve',
+                        type=int,
+                        metavar='PORT',
+                        help='Coordinate a run: hand the patch jobs to workers connecting to this port, instead of patching locally. ' +
+                            '--jobs sets how many jobs are handed out at the same time.')
+    parser.add_argument('--worker',
+                        metavar='URL',
+                        help='Work for the coordinator at this URL (like http://host:port), patching --jobs APKs at the same time, until stopped.')
+    parser.add_argument('--token',
+                        default=settings['workerToken'],
+                        help='A shared secret the coordinator and its workers authenticate each other with, required by --serve and --worker.')
+    parser.add_argument('--plan',
+                        action='store_true',
+                        help='Print what a run would do, with time and download estimates from earlier runs, then exit. ' +
+                            'Only local files and cached release data are used: nothing is downloaded or patched.')
+    parser.add_argument('--list', '-l',
+                        action='store_true',
+                        help='List the selectable apps supported by the patch source with their newest supported version, then exit.')
+    
+    for tool in Patcher.tools:
+        parser.add_argument('--{}-version'.format(tool),
+                            type=versionCheck,
+                            help='The tool version to use (default: the version configured for the patch source)')
+    args = parser.parse_args()
+    if (args.serve or args.worker) and not args.token:
+        # The coordinator serves the keystore, so it never runs open
+        parser.error('--serve and --worker need a --token (or the workerToken setting)')
+
+    os.makedirs(Path(args.toolsDir, 'cache'), exist_ok=True)
+    if args.plan:
+        # Planning only reads cached release data, and needs no java
+        args.offline = True
+    elif not Patcher.CheckJava(Path(args.toolsDir, 'cache', 'java.json')):
+        exit(1)
+    metrics.Configure(settings['metricsDir'])
+    if args.worker:
+        worker = RemoteWorker(
+            args.worker, Path(args.toolsDir, 'cache', 'blobs'), Path(args.toolsDir, 'work'),
+            Governor(settings['governor'], Path(args.toolsDir, 'cache', 'jvm-memory.json')),
+            token=args.token, slots=max(1, args.jobs), heartbeatInterval=settings['heartbeatInterval'],
+            idleTimeout=settings['watchdog']['idleSeconds'], totalTimeout=settings['watchdog']['patchSeconds'])
+        try:
+            worker.Run()
+        except KeyboardInterrupt:
+            print('### Stopped working.')
+        return
+    ledger = Ledger(Path(args.toolsDir, 'cache', 'jobs.sqlite'))
+    targets = getattr(args, 'files or apps') or glob.glob(os.path.join(settings['srcDir'], '*.apk'))
+    run = None
+    if args.resume:
+        unfinished = ledger.UnfinishedRun()
+        if not unfinished:
+            print('### There is no unfinished run to resume.')
+            return
+        run, targets, args.patchSrc = unfinished
+        print('### Resuming the run of {} with {}.'.format(', '.join(targets), ','.join(args.patchSrc)))
+
+    coordinator = None
+    if args.serve:
+        try:
+            coordinator = Coordinator(('', args.serve), token=args.token,
+                                      heartbeatTimeout=settings['heartbeatTimeout'])
+        except OSError as e:
+            print('### Error: Cannot listen on port {}: {}'.format(args.serve, e.strerror or e))
+            ledger.Close()
+            exit(1)
+        print('### Handing the patch jobs to workers on port {}.'.format(args.serve))
+
+    if args.watch:
+        # Revalidate the release metadata on every poll
+        args.cache_ttl = 0
+        try:
+            Watcher(args, targets, ledger, coordinator).Run(args.watch_interval, settings['watchJitter'])
+        except KeyboardInterrupt:
+            print('### Stopped watching.')
+        finally:
+            ledger.Close()
+            if coordinator:
+                coordinator.Close()
+        return
+
+    try:
+        patchers = createPatchers(args, coordinator)
+    except RuntimeError as e:
+        print('### Error: {}'.format(e))
+        exit(1)
+    try:
+        if args.list:
+            for patcher in patchers:
+                patcher.ListApps()
+            return
+        if args.cache_stats:
+            patchers[0].PrintCacheStats()
+            return
+        if args.plan:
+            estimator = Estimator(metrics.History())
+            downloads = set()
+            printPlan([action for patcher in patchers for action in patcher.Plan(targets, estimator, patchers[0], downloads)])
+            return
+
+        unsupported = [i for i in targets
+                       if i in appMap.keys() and not any(patcher.IsSupported(i) for patcher in patchers)]
+        if unsupported:
+            parser.error('not supported by the {} patches: "{}"'.format(','.join(args.patchSrc), '", "'.join(unsupported)))
+        if run is None:
+            run = ledger.StartRun(targets, args.patchSrc)
+        scheduler = Scheduler(patchers, patchJobs=args.jobs, downloadJobs=args.download_jobs,
+                              batchSize=settings['downloadBatchSize'], ledger=ledger, run=run)
+        jobs = scheduler.Run(targets)
+        patchers[0].EnforceRetention()
+        metrics.Summary()
+        if not Scheduler.Report(jobs):
+            exit(1)
+        ledger.FinishRun(run)
+    except RuntimeError as e:
+        # The tools are fetched on first use, so a missing tool surfaces here
+        print('### Error: {}'.format(e))
+        exit(1)
+    except KeyboardInterrupt:
+        print('### Stopped. Run "python patch.py --resume" to continue.')
+        exit(130)
+    finally:
+        for patcher in patchers:
+            patcher.Close()
+        if coordinator:
+            coordinator.Close()
+        ledger.Close()
+        metrics.Export()
+
+
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
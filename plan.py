@@ -0,0 +1,77 @@
+"""
+Dry runs: the actions a run would take, with time and byte estimates from the stage
+metrics that earlier runs recorded.
+"""
+
+import statistics
+
+
+class Estimator:
+    '''Estimates stages from the successful records of earlier runs. A stage is estimated from the
+    records of the same app and patch source if there are any, else of the same app, else of the same
+    source, else from all of its records. Records of batches count per app.'''
+
+    def __init__(self, records):
+        self.records = [i for i in records if i.get('ok') and 'wall' in i]
+
+    def Time(self, stage, app = None, source = None):
+        '''Returns the median seconds of a stage, or None if it never ran'''
+        records = self.__matching(stage, app, source)
+        return statistics.median(i['wall'] / i.get('apps', 1) for i in records) if records else None
+
+    def Bytes(self, stage, app = None, source = None):
+        '''Returns the median bytes of a stage, or None if it never ran'''
+        records = self.__matching(stage, app, source)
+        return statistics.median(i.get('bytes', 0) / i.get('apps', 1) for i in records) if records else None
+
+    def DownloadTime(self, stage, size, app = None, source = None):
+        '''Estimates a download by its size and the stage's past throughput, or by its past times'''
+        records = [i for i in self.records if i['stage'] == stage and i.get('bytes')]
+        wall = sum(i['wall'] for i in records)
+        if size and wall:
+            return size / (sum(i['bytes'] for i in records) / wall)
+        return self.Time(stage, app, source)
+
+    def __matching(self, stage, app, source):
+        records = [i for i in self.records if i['stage'] == stage]
+        wanted = {'app': app, 'source': source}
+        for keys in (('app', 'source'), ('app',), ('source',)):
+            if any(wanted[key] is None for key in keys):
+                continue
+            matching = [i for i in records if all(i.get(key) == wanted[key] for key in keys)]
+            if matching:
+                return matching
+        return records
+
+
+def formatDuration(seconds):
+    if seconds is None:
+        return '?'
+    if seconds < 1:
+        return '<1 s'
+    if seconds < 120:
+        return '{:.0f} s'.format(seconds)
+    if seconds < 7200:
+        return '{:.0f} min'.format(seconds / 60)
+    return '{:.1f} h'.format(seconds / 3600)
+
+
+# Actions that use what is already there, and take no noticeable time
+freeActions = ('use', 'restore', 'use APK', 'reuse build', 'skip')
+
+
+def printPlan(actions):
+    '''Prints the planned actions, each a dict of source, target, action, detail, seconds and bytes,
+    and their estimated totals'''
+    print('### {:<5} {:<24} {:<14} {:<40} {:>8} {:>9}'.format('Src', 'Target', 'Action', 'Detail', 'Time', 'MB'))
+    for action in actions:
+        print('### {:<5} {:<24} {:<14} {:<40} {:>8} {:>9}'.format(
+            action['source'], action['target'], action['action'], action['detail'],
+            '' if action['action'] in freeActions else formatDuration(action['seconds']),
+            '{:.1f}'.format(action['bytes'] / (1 << 20)) if action['bytes'] else ''))
+    costly = [i for i in actions if i['action'] not in freeActions]
+    unknown = sum(i['seconds'] is None for i in costly)
+    downloads = sum(i['bytes'] or 0 for i in costly if i['action'].startswith('download'))
+    print('### Estimated: {} one after another, {:.1f} MB to download{}.'.format(
+        formatDuration(sum(i['seconds'] or 0 for i in costly)), downloads / (1 << 20),
+        ', plus {} action{} without earlier timings'.format(unknown, 's' if unknown > 1 else '') if unknown else ''))
@@ -0,0 +1,54 @@
+"""
+Progress of patch runs, followed through the output lines of revanced-cli.
+"""
+
+import collections
+import re
+
+# The output lines with which revanced-cli starts each phase of a patch run
+phases = [
+    ('loading', re.compile(r'^Loading patches')),
+    ('decoding', re.compile(r'^(?:Decoding|Reading)')),
+    ('patching', re.compile(r'^(?:Executing|Applying) patches')),
+    ('compiling', re.compile(r'^Compiling')),
+    ('writing', re.compile(r'^(?:Writing|Aligning)')),
+    ('signing', re.compile(r'^Signing')),
+]
+patchResult = re.compile(r'^"(.+)" (succeeded|failed)')
+
+
+class PatchProgress:
+    '''Turns the output lines of a patch run into events, passed to onEvent as (event, detail):
+    ('phase', name) when a phase starts, and ('applied' or 'failed', patch name) for each patch.
+    The last output lines are kept in tail, to explain a failure.'''
+
+    def __init__(self, onEvent, tailLines = 30):
+        self.onEvent = onEvent
+        self.phase = None
+        self.applied = 0
+        self.failed = []
+        self.tail = collections.deque(maxlen=tailLines)
+
+    def Feed(self, line):
+        '''Takes the next output line'''
+        self.tail.append(line)
+        text = re.sub(r'^(?:INFO|WARNING|SEVERE|FINE):\s*', '', line.strip())
+        match = patchResult.match(text)
+        if match:
+            self.__enter('patching')
+            if match[2] == 'succeeded':
+                self.applied += 1
+                self.onEvent('applied', match[1])
+            else:
+                self.failed.append(match[1])
+                self.onEvent('failed', match[1])
+            return
+        for phase, regex in phases:
+            if regex.match(text):
+                self.__enter(phase)
+                return
+
+    def __enter(self, phase):
+        if phase != self.phase:
+            self.phase = phase
+            self.onEvent('phase', phase)
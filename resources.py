@@ -0,0 +1,238 @@
+"""
+Memory and CPU admission control for the concurrently running patch JVMs,
+and a watchdog stopping patcher and downloader processes that hang.
+"""
+
+import io
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from util import readJson, writeJson
+
+
+def totalMemoryMB():
+    '''Returns the physical memory of the machine, or None if it can't be determined'''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1 << 20)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def availableMemoryMB():
+    '''Returns the memory available for new processes, or None if it can't be determined'''
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+class ProcessTimeout(RuntimeError):
+    '''A process was stopped by its watchdog'''
+
+
+class ProcessStopped(ProcessTimeout):
+    '''A process was stopped, or not started, because the run is being interrupted'''
+
+
+class Watchdog:
+    '''Calls kill once a process printed nothing for idleTimeout seconds, or ran for totalTimeout seconds.
+    Either limit can be None. Output is reported with Touch; the reason for a kill is kept in reason.'''
+
+    def __init__(self, kill, idleTimeout = None, totalTimeout = None):
+        self.kill = kill
+        self.idleTimeout = idleTimeout
+        self.totalTimeout = totalTimeout
+        self.started = self.active = time.monotonic()
+        self.reason = None
+        self.stopped = threading.Event()
+        if idleTimeout or totalTimeout:
+            threading.Thread(target=self.__watch, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+
+    def Touch(self):
+        self.active = time.monotonic()
+
+    def __watch(self):
+        while not self.stopped.wait(1):
+            now = time.monotonic()
+            if self.totalTimeout and now - self.started > self.totalTimeout:
+                self.reason = 'ran for over {} s'.format(self.totalTimeout)
+            elif self.idleTimeout and now - self.active > self.idleTimeout:
+                self.reason = 'printed nothing for {} s'.format(self.idleTimeout)
+            else:
+                continue
+            self.kill()
+            return
+
+
+def killProcess(process):
+    '''Kills a process, together with the processes it started if it leads its own process group'''
+    try:
+        if os.name == 'posix' and os.getpgid(process.pid) == process.pid:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except OSError:
+        # It already exited
+        pass
+
+
+# The processes runProcess is running, and whether they are being stopped (see stoppingProcesses)
+runningProcesses = set()
+runningLock = threading.Lock()
+stopping = threading.Event()
+
+
+@contextmanager
+def stoppingProcesses():
+    '''Kills the processes runProcess is running on any thread, and makes it refuse to start new ones
+    until the block ends. A process in a session of its own doesn't get the Ctrl+C of the terminal,
+    so an interrupted run stops them with this while its threads wind down.'''
+    with runningLock:
+        stopping.set()
+        processes = list(runningProcesses)
+    for process in processes:
+        killProcess(process)
+    try:
+        yield
+    finally:
+        stopping.clear()
+
+
+def runProcess(args, onLine = None, idleTimeout = None, totalTimeout = None, **kwargs):
+    '''Runs a process to completion, passing its output lines to onLine if given.
+    A watchdog kills it if it runs longer than totalTimeout seconds, or, while its output goes
+    to onLine, prints nothing for idleTimeout seconds; ProcessTimeout is raised then.
+    Returns its exit code and resource usage (None where unsupported). Raises ProcessStopped if the
+    run is being interrupted.'''
+    if onLine:
+        kwargs['stdout'] = subprocess.PIPE
+    if os.name == 'posix' and (idleTimeout or totalTimeout):
+        # A process group of its own, so the watchdog also stops the processes it started
+        kwargs['start_new_session'] = True
+    with runningLock:
+        if stopping.is_set():
+            raise ProcessStopped('{} was not started, as the run is stopping'.format(os.path.basename(str(args[0]))))
+        process = subprocess.Popen(args, **kwargs)
+        runningProcesses.add(process)
+    with Watchdog(lambda: killProcess(process), idleTimeout if onLine else None, totalTimeout) as watchdog:
+        try:
+            if onLine:
+                for line in io.TextIOWrapper(process.stdout, encoding='utf-8', errors='replace'):
+                    watchdog.Touch()
+                    onLine(line.rstrip('\n'))
+            if hasattr(os, 'wait4'):
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+            else:
+                process.wait()
+                usage = None
+        except BaseException:
+            # Outside of our process group, the process doesn't get the Ctrl+C that interrupted us
+            if process.returncode is None:
+                killProcess(process)
+                process.wait()
+            raise
+        finally:
+            with runningLock:
+                runningProcesses.discard(process)
+    if stopping.is_set():
+        raise ProcessStopped('{} was stopped, as the run is stopping'.format(os.path.basename(str(args[0]))))
+    if watchdog.reason:
+        raise ProcessTimeout('{} {}, so it was stopped'.format(os.path.basename(str(args[0])), watchdog.reason))
+    return process.returncode, usage
+
+
+class Governor:
+    '''Sizes the heap of each patch JVM and admits new ones only while the memory and core budgets allow.
+    Heap sizes are estimated from the input APK size, or from the peak memory of earlier runs of the same app.'''
+
+    def __init__(self, policy, historyPath):
+        self.policy = policy
+        self.historyPath = historyPath
+        self.history = readJson(historyPath, {})
+        total = totalMemoryMB()
+        self.memoryBudget = total * policy['memoryFraction'] if total else None
+        self.cores = policy['cores'] or os.cpu_count() or 1
+        self.reservedMemory = 0
+        self.reservedCores = 0
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def HeapSize(self, key, apkPath):
+        '''Estimates the heap in MB a patch of the APK needs'''
+        if key in self.history:
+            heap = self.history[key] * self.policy['headroom']
+        else:
+            heap = os.path.getsize(apkPath) / (1 << 20) * self.policy['heapPerApkMB']
+        return int(min(max(heap, self.policy['minHeapMB']), self.policy['maxHeapMB']))
+
+    def WorkerHeap(self, workers):
+        '''Returns the heap in MB of each of a number of warm JVM workers, so that together they fit the memory budget'''
+        heap = self.policy['maxHeapMB']
+        if self.memoryBudget:
+            heap = min(heap, self.memoryBudget / self.policy['jvmOverhead'] / workers)
+        return int(max(heap, self.policy['minHeapMB']))
+
+    def JvmArgs(self, heap):
+        '''Returns the JVM arguments enforcing a job's heap and core allowance'''
+        return ['-Xmx{}m'.format(heap), '-XX:ActiveProcessorCount={}'.format(self.__jobCores())]
+
+    @contextmanager
+    def Admit(self, heap):
+        '''Waits until a JVM with the given heap fits the budgets, and reserves its share while it runs'''
+        memory = heap * self.policy['jvmOverhead']
+        cores = self.__jobCores()
+        with self.condition:
+            while not self.__fits(memory, cores):
+                # Free memory changes outside of our reservations, so re-check periodically
+                self.condition.wait(timeout=2)
+            self.reservedMemory += memory
+            self.reservedCores += cores
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.reservedMemory -= memory
+                self.reservedCores -= cores
+                self.running -= 1
+                self.condition.notify_all()
+
+    def Record(self, key, usage, success):
+        '''Remembers the peak memory of a finished patch, growing it after a failure to allow for OOMs'''
+        if not usage:
+            return
+        # ru_maxrss is in kilobytes on Linux
+        peak = usage.ru_maxrss / 1024
+        if not success:
+            peak *= self.policy['failureGrowth']
+        with self.condition:
+            self.history[key] = round(peak)
+            writeJson(self.historyPath, self.history)
+
+    def __jobCores(self):
+        return max(1, min(self.policy['coresPerJob'], self.cores))
+
+    def __fits(self, memory, cores):
+        if not self.running:
+            # A job larger than the budgets still runs, just alone
+            return True
+        if self.reservedCores + cores > self.cores:
+            return False
+        if self.memoryBudget and self.reservedMemory + memory > self.memoryBudget:
+            return False
+        available = availableMemoryMB()
+        return available is None or memory <= available
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+"""
+A content-addressed store for the downloaded APKs, the patched APKs and the tools.
+Identical files are kept once, as reflinks or hard links of one object, and an index maps
+each app or tool version to its content hash, so earlier versions can be restored.
+Run "python store.py --help" to list or restore stored files.
+"""
+
+import argparse
+import os
+import shutil
+import threading
+import time
+from util import fileHash, readJson, writeJson
+
+# The FICLONE ioctl, which makes a copy-on-write clone of a file on Linux (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+
+def cloneFile(srcPath, dstPath):
+    '''Places a file at dstPath sharing the storage of srcPath: a reflink where supported, as
+    writing to it then can't change the source, otherwise a hard link, otherwise a copy'''
+    tempPath = '{}.{}.tmp'.format(dstPath, threading.get_ident())
+    try:
+        import fcntl
+        with open(srcPath, 'rb') as src, open(tempPath, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (ImportError, OSError):
+        try:
+            os.remove(tempPath)
+        except OSError:
+            pass
+        try:
+            os.link(srcPath, tempPath)
+        except OSError:
+            shutil.copyfile(srcPath, tempPath)
+    os.replace(tempPath, dstPath)
+
+
+class ArtifactStore:
+    '''Keeps every artifact as an object named by its SHA-256 hash, and records which app or tool
+    version (kind, name, version, patch source) it is and where it is checked out. Retention keeps
+    the newest versions of each name and a total byte budget; the newest version is never evicted.'''
+
+    def __init__(self, directory, keepVersions = 3, budgetBytes = None, hashFunction = fileHash):
+        self.directory = directory
+        self.objectsDir = os.path.join(directory, 'objects')
+        self.indexPath = os.path.join(directory, 'index.json')
+        self.keepVersions = keepVersions
+        self.budgetBytes = budgetBytes
+        self.hashFunction = hashFunction
+        self.lock = threading.Lock()
+        os.makedirs(self.objectsDir, exist_ok=True)
+        self.index = readJson(self.indexPath, {'artifacts': []})
+
+    def Add(self, path, kind, name, version = None, source = None, paths = ()):
+        '''Stores a file and records what it is. The file, and any other given paths holding the
+        same content, are replaced by clones of the stored object. Returns the content hash.'''
+        digest = self.hashFunction(path)
+        objectPath = self.__objectPath(digest)
+        with self.lock:
+            if not os.path.exists(objectPath):
+                os.makedirs(os.path.dirname(objectPath), exist_ok=True)
+                cloneFile(path, objectPath)
+            paths = [os.path.abspath(i) for i in (path, *paths)]
+            for otherPath in paths:
+                if not os.path.samefile(objectPath, otherPath):
+                    cloneFile(objectPath, otherPath)
+            artifacts = self.index['artifacts']
+            artifact = next((i for i in artifacts if (i['kind'], i['name'], i['version'], i['source'], i['hash']) ==
+                             (kind, name, version, source, digest)), None)
+            if artifact:
+                artifact['paths'] = sorted(set(artifact['paths']) | set(paths))
+                artifact['added'] = time.time()
+            else:
+                artifacts.append({
+                    'kind': kind,
+                    'name': name,
+                    'version': version,
+                    'source': source,
+                    'file': os.path.basename(path),
+                    'hash': digest,
+                    'size': os.path.getsize(objectPath),
+                    'paths': paths,
+                    'added': time.time()
+                })
+            self.__save()
+        return digest
+
+    def Find(self, kind, file):
+        '''Returns the newest stored artifact of a kind with the given file name, or None'''
+        with self.lock:
+            matches = [i for i in self.index['artifacts'] if i['kind'] == kind and i['file'] == file
+                       and os.path.exists(self.__objectPath(i['hash']))]
+        return max(matches, key=lambda i: i['added']) if matches else None
+
+    def Artifacts(self):
+        with self.lock:
+            return [dict(i) for i in self.index['artifacts']]
+
+    def Checkout(self, digest, path):
+        '''Places a stored object at a path. Returns False if it is not in the store'''
+        objectPath = self.__objectPath(digest)
+        if not os.path.exists(objectPath):
+            return False
+        cloneFile(objectPath, path)
+        return True
+
+    def Enforce(self):
+        '''Evicts artifacts beyond the newest versions kept per name, then the oldest ones while
+        the store is over its byte budget. Returns the number of bytes freed.'''
+        with self.lock:
+            artifacts = sorted(self.index['artifacts'], key=lambda i: i['added'], reverse=True)
+            kept, evicted, versions = [], [], {}
+            for artifact in artifacts:
+                group = versions.setdefault((artifact['kind'], artifact['name'], artifact['source']), [])
+                (kept if len(group) < self.keepVersions else evicted).append(artifact)
+                group.append(artifact)
+            if self.budgetBytes is not None:
+                newest = {id(group[0]) for group in versions.values()}
+                total = sum(i['size'] for i in {i['hash']: i for i in kept}.values())
+                for artifact in reversed(list(kept)):
+                    if total <= self.budgetBytes:
+                        break
+                    if id(artifact) in newest:
+                        continue
+                    kept.remove(artifact)
+                    evicted.append(artifact)
+                    if not any(i['hash'] == artifact['hash'] for i in kept):
+                        total -= artifact['size']
+            freed = 0
+            for artifact in evicted:
+                objectPath = self.__objectPath(artifact['hash'])
+                # Checked out copies that were since replaced by other content are left alone
+                for path in artifact['paths']:
+                    if self.__sameFile(objectPath, path) and not any(path in i['paths'] for i in kept):
+                        os.remove(path)
+                if not any(i['hash'] == artifact['hash'] for i in kept) and os.path.exists(objectPath):
+                    freed += artifact['size']
+                    os.remove(objectPath)
+            self.index['artifacts'] = kept
+            self.__save()
+        return freed
+
+    def __objectPath(self, digest):
+        return os.path.join(self.objectsDir, digest[:2], digest)
+
+    def __save(self):
+        writeJson(self.indexPath, self.index)
+
+    def __sameFile(self, objectPath, path):
+        '''Whether a path still holds an object: the same inode, or for a reflink or copy the same content'''
+        try:
+            if os.path.samefile(objectPath, path):
+                return True
+            return (os.path.getsize(objectPath) == os.path.getsize(path) and
+                    self.hashFunction(path) == os.path.basename(objectPath))
+        except OSError:
+            return False
+
+
+def main():
+    from device import settings
+    parser = argparse.ArgumentParser(
+        prog='ReVanced Auto Patcher store',
+        description='Lists the stored APKs, patched APKs and tools, or restores one of them.')
+    parser.add_argument('--store',
+                        default=os.path.join(settings['toolsDir'], 'store'),
+                        help='The store directory (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='List the stored artifacts, newest first')
+    checkout = commands.add_parser('checkout', help='Restore a stored artifact by its hash (or a unique prefix of it)')
+    checkout.add_argument('hash')
+    checkout.add_argument('path')
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.store)
+    artifacts = sorted(store.Artifacts(), key=lambda i: i['added'], reverse=True)
+    if args.command == 'list':
+        for artifact in artifacts:
+            print('{:<8} {:<5} {:<40} {:>9.1f} MB  {}  {}'.format(
+                artifact['kind'], artifact['source'] or '', artifact['file'], artifact['size'] / (1 << 20),
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(artifact['added'])), artifact['hash'][:16]))
+        return
+    matches = {i['hash'] for i in artifacts if i['hash'].startswith(args.hash.lower())}
+    if len(matches) != 1 or not store.Checkout(matches.pop(), args.path):
+        print('### Error: no single stored artifact matches {}.'.format(args.hash))
+        exit(1)
+    print('### Restored {}.'.format(args.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+The coordinator's authentication, and jobs run by several worker processes on localhost, one of
+which stops sending heartbeats. The workers run a stand-in for java.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+from device import settings
+from distributed import Coordinator, RemoteWorker
+from resources import Governor
+
+# Stands in for java running revanced-cli's patch command: copies the APK to --out, creates the
+# keystore, and takes the next of the seconds listed in STUB_SECONDS for each run
+javaStub = '''#!{python}
+import os, shutil, sys, time
+args = sys.argv[1:]
+countPath = os.path.join(os.environ['STUB_DIR'], 'runs')
+runs = len(open(countPath).read()) if os.path.exists(countPath) else 0
+with open(countPath, 'a') as file:
+    file.write('x')
+time.sleep(float(os.environ['STUB_SECONDS'].split(',')[runs]))
+open(args[args.index('--keystore') + 1], 'wb').write(b'keys')
+shutil.copy(args[-1], args[args.index('--out') + 1])
+print('INFO: done')
+'''
+
+
+class CoordinatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.keystorePath = os.path.join(self.directory, 'patch.keystore')
+        with open(self.keystorePath, 'wb') as file:
+            file.write(b'secret keys')
+        self.keystoreHash = hashlib.sha256(b'secret keys').hexdigest()
+        self.coordinator = Coordinator(('127.0.0.1', 0), token='s3cret')
+        self.addCleanup(self.coordinator.Close)
+        self.url = 'http://127.0.0.1:{}'.format(self.coordinator.server_address[1])
+        # Serve the keystore as a job would
+        self.coordinator.blobs[self.keystoreHash] = self.keystorePath
+
+    def request(self, path, token = None, data = None):
+        headers = {'Authorization': 'Bearer ' + token} if token else {}
+        request = urllib.request.Request(self.url + path, data=data, headers=headers)
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read()
+
+    def testRequiresAToken(self):
+        with self.assertRaises(ValueError):
+            Coordinator(('127.0.0.1', 0), token=None)
+
+    def testServesTheKeystoreOnlyWithTheToken(self):
+        for token in (None, 'wrong', 's3cret0'):
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                self.request('/blobs/{}.keystore'.format(self.keystoreHash), token)
+            self.assertEqual(context.exception.code, 401)
+        self.assertEqual(self.request('/blobs/{}.keystore'.format(self.keystoreHash), 's3cret'), (200, b'secret keys'))
+
+    def testClaimsNeedTheToken(self):
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self.request('/jobs/claim', data=b'{"worker": "w"}')
+        self.assertEqual(context.exception.code, 401)
+        self.assertEqual(self.request('/jobs/claim', 's3cret', b'{"worker": "w"}')[0], 204)
+
+    def testPortInUse(self):
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen()
+            with self.assertRaises(OSError):
+                Coordinator(('127.0.0.1', listener.getsockname()[1]), token='s3cret')
+
+
+class WorkersTest(unittest.TestCase):
+    '''A coordinator with two workers: the first stops sending heartbeats during its job, so the job is
+    handed to the second, and the first one's late result is refused'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        binDir = os.path.join(self.directory, 'bin')
+        os.makedirs(binDir)
+        with open(os.path.join(binDir, 'java'), 'w') as file:
+            file.write(javaStub.format(python=sys.executable))
+        os.chmod(os.path.join(binDir, 'java'), 0o755)
+        # The first run outlasts the heartbeat timeout, and the second ends after the first
+        environment = mock.patch.dict(os.environ, {
+            'PATH': binDir + os.pathsep + os.environ['PATH'], 'STUB_DIR': self.directory, 'STUB_SECONDS': '2,4'})
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.coordinator = Coordinator(('127.0.0.1', 0), token='s3cret', heartbeatTimeout=1)
+        self.addCleanup(self.coordinator.Close)
+        self.url = 'http://127.0.0.1:{}'.format(self.coordinator.server_address[1])
+        self.replies = []
+        urlopen = urllib.request.urlopen
+
+        def recordingUrlopen(request, *args, **kwargs):
+            '''Records the (worker, method, path, status) of the workers' requests'''
+            worker = request.get_header('X-worker') or json.loads(request.data)['worker']
+            reply = [worker, request.get_method(), request.full_url[len(self.url):]]
+            try:
+                response = urlopen(request, *args, **kwargs)
+            except urllib.error.HTTPError as e:
+                self.replies.append(tuple(reply + [e.code]))
+                raise
+            self.replies.append(tuple(reply + [response.status]))
+            return response
+        recording = mock.patch.object(urllib.request, 'urlopen', recordingUrlopen)
+        recording.start()
+        self.addCleanup(recording.stop)
+
+    def worker(self, name, heartbeatInterval):
+        worker = RemoteWorker(
+            self.url, os.path.join(self.directory, name, 'blobs'), os.path.join(self.directory, name, 'work'),
+            Governor(settings['governor'], os.path.join(self.directory, name, 'memory.json')), name=name,
+            token='s3cret', pollInterval=0.1, heartbeatInterval=heartbeatInterval)
+        worker.thread = threading.Thread(target=worker.Run)
+        worker.thread.start()
+        self.addCleanup(worker.thread.join)
+        self.addCleanup(worker.Stop)
+        return worker
+
+    def file(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path, hashlib.sha256(data).hexdigest()
+
+    def testReassignsTheJobOfASilentWorker(self):
+        keystorePath = os.path.join(self.directory, 'patch.keystore')
+        blobs = {
+            'cli': self.file('cli.jar', b'cli'),
+            'apk': self.file('app.apk', b'apk data'),
+            'keystore': self.file('patch.keystore', b'keys')
+        }
+        outPath = os.path.join(self.directory, 'out.apk')
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.coordinator.Run(
+            ['patch', '--out', '{out}', '--keystore', '{keystore}', '{apk}'], blobs, 768, outPath, keystorePath)))
+        thread.start()
+
+        slow = self.worker('slow', 0.2)
+        deadline = time.monotonic() + 10
+        while ('slow', 'POST', '/jobs/1/heartbeat', 200) not in self.replies and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # The slow worker stops sending heartbeats after its first one
+        slow.heartbeatInterval = 3600
+        fast = self.worker('fast', 0.2)
+        thread.join(30)
+        for worker in (slow, fast):
+            worker.Stop()
+            worker.thread.join()
+
+        self.assertEqual(result, [0])
+        with open(outPath, 'rb') as file:
+            self.assertEqual(file.read(), b'apk data')
+        claims = [i[0] for i in self.replies if i[2] == '/jobs/claim' and i[3] == 200]
+        self.assertEqual(claims, ['slow', 'fast'])
+        self.assertIn(('slow', 'PUT', '/jobs/1/result', 409), self.replies)
+        self.assertIn(('fast', 'PUT', '/jobs/1/result', 200), self.replies)
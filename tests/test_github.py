@@ -0,0 +1,60 @@
+"""
+The release metadata cache against a stand-in for the GitHub API.
+"""
+
+import shutil
+import tempfile
+import unittest
+from bench import FakeGitHub
+from github import ReleaseCache
+
+path = '/repos/revanced/revanced-cli/releases/latest'
+
+
+class ReleaseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = FakeGitHub({}, {path: {'tag_name': 'v5.0.0', 'assets': []}})
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def cache(self, ttl = 3600, offline = False):
+        return ReleaseCache(self.directory, ttl, offline, self.server.url)
+
+    def testFetchesOnceWithinTheTtl(self):
+        self.assertEqual(self.cache().Release('revanced/revanced-cli')['tag_name'], 'v5.0.0')
+        self.assertEqual(self.cache().Release('revanced/revanced-cli')['tag_name'], 'v5.0.0')
+        self.assertEqual(self.server.requests, [(path, 200)])
+
+    def testRevalidatesWithTheEtagAfterTheTtl(self):
+        self.cache(ttl=0).Release('revanced/revanced-cli')
+        self.assertEqual(self.cache(ttl=0).Release('revanced/revanced-cli')['tag_name'], 'v5.0.0')
+        self.server.releases[path] = {'tag_name': 'v5.1.0', 'assets': []}
+        self.assertEqual(self.cache(ttl=0).Release('revanced/revanced-cli')['tag_name'], 'v5.1.0')
+        self.assertEqual(self.server.requests, [(path, 200), (path, 304), (path, 200)])
+
+    def testRevalidationRestartsTheTtl(self):
+        self.cache(ttl=0).Release('revanced/revanced-cli')
+        self.cache(ttl=0).Release('revanced/revanced-cli')
+        self.cache().Release('revanced/revanced-cli')
+        self.assertEqual(self.server.requests, [(path, 200), (path, 304)])
+
+    def testFallsBackToStaleData(self):
+        self.cache(ttl=0).Release('revanced/revanced-cli')
+        del self.server.releases[path]
+        self.assertEqual(self.cache(ttl=0).Release('revanced/revanced-cli')['tag_name'], 'v5.0.0')
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertEqual(self.cache(ttl=0).Release('revanced/revanced-cli')['tag_name'], 'v5.0.0')
+
+    def testFailsWithoutCachedData(self):
+        with self.assertRaises(RuntimeError):
+            self.cache().Release('revanced/revanced-patches')
+
+    def testOfflineOnlyReadsTheCache(self):
+        self.assertIsNone(self.cache(offline=True).Release('revanced/revanced-cli'))
+        self.cache().Release('revanced/revanced-cli')
+        self.assertEqual(self.cache(ttl=0, offline=True).Release('revanced/revanced-cli')['tag_name'], 'v5.0.0')
+        self.assertEqual(self.server.requests, [(path, 200)])
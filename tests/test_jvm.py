@@ -0,0 +1,79 @@
+"""
+Runs the warm JVM worker against a stand-in revanced-cli jar. Like the real cli, the jar's
+MainCommand is not a public class. Skipped where no JDK is installed.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import zipfile
+from jvm import JvmPool, WorkerError
+
+# Stand-ins for picocli and the cli's command. MainCommand is package-private, like the
+# class of the Kotlin "private object MainCommand".
+standInSources = {
+    'picocli/CommandLine.java': '''
+package picocli;
+public class CommandLine {
+    private final Object command;
+    public CommandLine(Object command) { this.command = command; }
+    public int execute(String... args) {
+        System.out.println("ran " + String.join(" ", args) + " with " + command.getClass().getSimpleName());
+        java.util.logging.Logger.getLogger("cli").info("\\"Hide ads\\" succeeded");
+        return args.length;
+    }
+}
+''',
+    'app/revanced/cli/command/MainCommand.java': '''
+package app.revanced.cli.command;
+final class MainCommand {
+    public static final MainCommand INSTANCE = new MainCommand();
+    private MainCommand() { }
+}
+''',
+}
+
+
+@unittest.skipUnless(shutil.which('java') and shutil.which('javac'), 'needs a JDK')
+class JvmWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        sourceDir = os.path.join(self.directory, 'src')
+        classDir = os.path.join(self.directory, 'classes')
+        paths = []
+        for name, source in standInSources.items():
+            paths.append(os.path.join(sourceDir, name))
+            os.makedirs(os.path.dirname(paths[-1]), exist_ok=True)
+            with open(paths[-1], 'w') as file:
+                file.write(source)
+        subprocess.run(['javac', '-d', classDir, *paths], check=True)
+        self.cliPath = os.path.join(self.directory, 'revanced-cli-all.jar')
+        with zipfile.ZipFile(self.cliPath, 'w') as jar:
+            for root, _, names in os.walk(classDir):
+                for name in names:
+                    jar.write(os.path.join(root, name), os.path.relpath(os.path.join(root, name), classDir))
+
+    def testRunsCommandsOnTheNonPublicMainCommand(self):
+        pool = JvmPool(self.directory, 1, ['-Xmx256m'], 20)
+        self.addCleanup(pool.Close)
+        for _ in range(2):
+            lines = []
+            self.assertEqual(pool.Run(self.cliPath, ['patch', 'x.apk'], lines.append), 2)
+            self.assertIn('ran patch x.apk with MainCommand', lines)
+            self.assertIn('INFO: "Hide ads" succeeded', lines)
+
+    def testStopsTryingAfterTheWorkerFailsToStart(self):
+        brokenPath = os.path.join(self.directory, 'broken.jar')
+        with zipfile.ZipFile(brokenPath, 'w') as jar:
+            jar.writestr('empty.txt', '')
+        pool = JvmPool(self.directory, 1, ['-Xmx256m'], 20)
+        self.addCleanup(pool.Close)
+        with self.assertRaises(WorkerError):
+            pool.Run(brokenPath, ['patch'], print)
+        self.assertIsNotNone(pool.startError)
+        with self.assertRaises(WorkerError):
+            pool.Run(self.cliPath, ['patch'], print)
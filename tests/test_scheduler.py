@@ -0,0 +1,129 @@
+"""
+The scheduler's jobs across several patch sources, with stand-ins for the patchers.
+"""
+
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+import patch
+import resources
+from ledger import Ledger
+from resources import runProcess
+
+both, rvOnly = list(patch.appMap.keys())[:2]
+
+
+class FakePatcher:
+    '''Stands in for a patch source: it supports the apps in its versions map, "downloads" an
+    empty file per app and version, and "patches" by copying it'''
+
+    def __init__(self, patchSrc, versions, directory):
+        self.patchSrc = patchSrc
+        self.versions = versions
+        self.directory = directory
+        self.patched = []
+
+    def Accepts(self, target):
+        return target in self.versions
+
+    def IsSupported(self, appId):
+        return appId in self.versions
+
+    def AppVersion(self, appId):
+        if appId not in self.versions:
+            raise RuntimeError('{} is not supported'.format(appId))
+        return self.versions[appId]
+
+    def DownloadAll(self, appIds, versions = None):
+        paths = {}
+        for appId in appIds:
+            paths[appId] = os.path.join(self.directory, '{} {}.apk'.format(appId, versions[appId]))
+            open(paths[appId], 'w').close()
+        return paths
+
+    def CheckApk(self, srcPath, appId = None):
+        return appId
+
+    def OutPath(self, srcPath):
+        return os.path.join(self.directory, self.patchSrc + ' ' + os.path.basename(srcPath))
+
+    def Patch(self, srcPath, app, optionsPath = None):
+        shutil.copy(srcPath, self.OutPath(srcPath))
+        self.patched.append(app)
+        return True
+
+    def EnforceRetention(self):
+        pass
+
+    def Close(self):
+        pass
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.ledger = Ledger(os.path.join(self.directory, 'jobs.sqlite'))
+        self.addCleanup(self.ledger.Close)
+        self.patchers = [
+            FakePatcher('rv', {both: '1.0', rvOnly: '2.0'}, self.directory),
+            FakePatcher('rvx', {both: '1.0'}, self.directory)
+        ]
+
+    def testSkipsTheSourcesThatDontSupportAnApp(self):
+        run = self.ledger.StartRun([both, rvOnly], ['rv', 'rvx'])
+        jobs = patch.Scheduler(self.patchers, ledger=self.ledger, run=run).Run([both, rvOnly])
+        self.assertEqual(sorted(self.patchers[0].patched), sorted([both, rvOnly]))
+        self.assertEqual(self.patchers[1].patched, [both])
+        skipped = [(i.target, i.patcher.patchSrc) for i in jobs if i.skipped]
+        self.assertEqual(skipped, [(rvOnly, 'rvx')])
+        self.assertTrue(patch.Scheduler.Report(jobs))
+        self.assertEqual(self.ledger.Jobs(run)[rvOnly, 'rvx']['stage'], 'skipped')
+
+    def testFailuresAreNotSkipped(self):
+        self.patchers[1].Patch = lambda *args: False
+        jobs = patch.Scheduler(self.patchers).Run([both, rvOnly])
+        failed = [(i.target, i.patcher.patchSrc) for i in jobs if not i.success and not i.skipped]
+        self.assertEqual(failed, [(both, 'rvx')])
+        self.assertFalse(patch.Scheduler.Report(jobs))
+
+    def testPreflightRejectionsAreNotResumed(self):
+        checked = []
+
+        def reject(srcPath, appId = None):
+            checked.append(appId)
+            raise ValueError('{} is not a supported version'.format(appId))
+        self.patchers[1].CheckApk = reject
+        run = self.ledger.StartRun([both, rvOnly], ['rv', 'rvx'])
+        jobs = patch.Scheduler(self.patchers, ledger=self.ledger, run=run).Run([both, rvOnly])
+        self.assertEqual([i.skipped for i in jobs if i.patcher.patchSrc == 'rvx'],
+                         [both + ' is not a supported version', 'not supported by the rvx patches'])
+        self.assertTrue(patch.Scheduler.Report(jobs))
+        # Resuming the run skips the rejected job without checking the APK again
+        jobs = patch.Scheduler(self.patchers, ledger=self.ledger, run=run).Run([both, rvOnly])
+        self.assertEqual(checked, [both])
+        self.assertTrue(all(i.success or i.skipped for i in jobs))
+
+    def testInterruptKillsTheRunningPatchers(self):
+        started = threading.Event()
+
+        def slowPatch(srcPath, app, optionsPath = None):
+            # Under a watchdog, the process runs in a session of its own, which doesn't get Ctrl+C
+            threading.Timer(0.5, started.set).start()
+            returncode, _ = runProcess(['sleep', '30'], totalTimeout=60)
+            return returncode == 0
+        self.patchers[0].Patch = slowPatch
+        threading.Thread(target=lambda: started.wait(10) and os.kill(os.getpid(), signal.SIGINT), daemon=True).start()
+        before = threading.active_count()
+        begin = time.monotonic()
+        with self.assertRaises(KeyboardInterrupt):
+            patch.Scheduler(self.patchers[:1]).Run([both])
+        self.assertLess(time.monotonic() - begin, 10)
+        self.assertEqual(resources.runningProcesses, set())
+        self.assertFalse(resources.stopping.is_set())
+        self.assertLessEqual(threading.active_count(), before)
@@ -0,0 +1,96 @@
+"""
+Watch mode: a poll rebuilds only the targets whose supported version or tools changed.
+The tool releases come from a stand-in for the GitHub API, and the patchers are replaced by
+stand-ins, so no tools or APKs are needed.
+"""
+
+import argparse
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import patch
+from bench import FakeGitHub
+from github import ReleaseCache
+from ledger import Ledger
+from tests.test_scheduler import FakePatcher, both, rvOnly
+
+
+class WatchedPatcher(FakePatcher):
+    '''A stand-in patcher whose tools are identified by the latest release of its patches'''
+
+    def __init__(self, patchSrc, versions, directory, releases):
+        super().__init__(patchSrc, versions, directory)
+        self.releases = releases
+
+    def ToolsKey(self):
+        return self.releases.Release('{}/patches'.format(self.patchSrc))['tag_name']
+
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.ledger = Ledger(directory + '/jobs.sqlite')
+        self.addCleanup(self.ledger.Close)
+        self.server = FakeGitHub({}, {
+            '/repos/rv/patches/releases/latest': {'tag_name': 'v5.0.0', 'assets': []},
+            '/repos/rvx/patches/releases/latest': {'tag_name': 'v1.0.0', 'assets': []}
+        })
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        # Watch mode revalidates the release metadata on every poll
+        releases = ReleaseCache(directory + '/releases', 0, apiUrl=self.server.url)
+        self.patchers = [
+            WatchedPatcher('rv', {both: '1.0', rvOnly: '2.0'}, directory, releases),
+            WatchedPatcher('rvx', {both: '1.0'}, directory, releases)
+        ]
+        args = argparse.Namespace(toolsDir=directory, patchSrc=['rv', 'rvx'], jobs=1, download_jobs=1)
+        self.watcher = patch.Watcher(args, [both, rvOnly], self.ledger)
+        createPatchers = mock.patch.object(patch, 'createPatchers', lambda *args: self.patchers)
+        createPatchers.start()
+        self.addCleanup(createPatchers.stop)
+
+    def testFirstPollBuildsEverything(self):
+        self.assertEqual(self.watcher.Poll(), [both, rvOnly])
+        self.assertEqual(sorted(self.patchers[0].patched), sorted([both, rvOnly]))
+        self.assertEqual(self.patchers[1].patched, [both])
+
+    def testUnchangedPollBuildsNothing(self):
+        self.watcher.Poll()
+        del self.server.requests[:]
+        # Including the app that only one of the sources supports
+        self.assertEqual(self.watcher.Poll(), [])
+        self.assertEqual([i[1] for i in self.server.requests], [304, 304])
+        self.assertEqual(len(self.patchers[0].patched), 2)
+
+    def testStateSurvivesARestart(self):
+        self.watcher.Poll()
+        watcher = patch.Watcher(self.watcher.args, self.watcher.targets, self.ledger)
+        self.assertEqual(watcher.Poll(), [])
+
+    def testNewSupportedVersionRebuildsOnlyItsApp(self):
+        self.watcher.Poll()
+        self.patchers[0].versions[rvOnly] = '2.1'
+        self.assertEqual(self.watcher.Poll(), [rvOnly])
+        self.assertEqual(self.watcher.Poll(), [])
+
+    def testNewTagRebuildsOnlyTheAppsOfItsSource(self):
+        self.watcher.Poll()
+        self.server.releases['/repos/rvx/patches/releases/latest'] = {'tag_name': 'v1.1.0', 'assets': []}
+        self.assertEqual(self.watcher.Poll(), [both])
+        self.assertIn(('/repos/rvx/patches/releases/latest', 200), self.server.requests[-2:])
+        self.assertEqual(self.patchers[1].patched, [both, both])
+
+    def testFailedBuildsAreTriedAgain(self):
+        self.patchers[1].Patch = lambda *args: False
+        self.assertEqual(self.watcher.Poll(), [both, rvOnly])
+        self.assertEqual(self.watcher.Poll(), [both])
+
+    def testRunKeepsGoingAfterAnError(self):
+        polls = mock.Mock(side_effect=[ValueError('bad data'), KeyboardInterrupt])
+        with mock.patch.object(self.watcher, 'Poll', polls), mock.patch.object(patch.time, 'sleep'):
+            with self.assertRaises(KeyboardInterrupt):
+                self.watcher.Run(0, 0)
+        self.assertEqual(polls.call_count, 2)
@@ -0,0 +1,85 @@
+"""
+Small helpers shared by the patcher modules.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import random
+import shutil
+import tempfile
+import uuid
+
+
+def fileHash(path, algorithm = 'sha256'):
+    '''Returns the hex digest of a file. Large files are hashed through mmap, others in chunks'''
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size >= 64 << 20:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+        else:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def readJson(path, default = None):
+    '''Reads a JSON file, returning the default if it is missing or corrupt'''
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return default
+
+
+def writeJson(path, data):
+    '''Writes a JSON file atomically, so readers never see a partial file'''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tempPath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file, indent=1)
+        os.replace(tempPath, path)
+    except BaseException:
+        os.remove(tempPath)
+        raise
+
+
+def backoffDelay(attempt, baseDelay, maxDelay):
+    '''Returns the wait before a retry: exponential backoff with full jitter, so failed jobs don't retry in lockstep'''
+    return random.uniform(0, min(maxDelay, baseDelay * 2 ** attempt))
+
+
+def versionKey(version):
+    '''Sort key of a dotted numeric version string'''
+    return tuple(int(x) for x in version.split('.') if x.isdigit())
+
+
+def replaceFile(srcPath, dstPath):
+    '''Moves a file into place atomically, copying it first if it is on another file system'''
+    try:
+        os.replace(srcPath, dstPath)
+    except OSError:
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dstPath)), suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(srcPath, tempPath)
+            os.replace(tempPath, dstPath)
+        except BaseException:
+            os.remove(tempPath)
+            raise
+        os.remove(srcPath)
+
+
+def removeTree(path):
+    '''Deletes a directory by first renaming it aside, so it never remains half deleted under its name'''
+    trashPath = '{}.trash-{}'.format(path, uuid.uuid4().hex[:12])
+    try:
+        os.rename(path, trashPath)
+    except OSError:
+        return
+    shutil.rmtree(trashPath, ignore_errors=True)